@@ -1,9 +1,11 @@
-import sys
+import os
+import json
+import time
 from time import sleep
 import redis
 import curses
 from curses import wrapper
-from datetime import datetime
+from threading import Thread, Lock
 
 VERSION = "1.00"
 
@@ -15,11 +17,49 @@ VERSION = "1.00"
 # environments. The default is that Redis is installed on localhost (127.0.0.1).
 REDIS_HOST = 'localhost'
 REDIS_PORT = 6379
+# If Redis is configured to listen on a Unix domain socket, this is used instead of REDIS_HOST and REDIS_PORT.
+# This avoids the TCP/IP overhead for the localhost communication. Set to an empty string to always use TCP/IP.
+REDIS_SOCKET = '/run/redis/redis-server.sock'
 # Offset where the images are drawn on the screen. please mind that information
 # messages are displayed on the first lines, so don't make DELTA_Y lower than 11.
 DELTA_X = 0
 DELTA_Y = 12
 
+# The static drawing of the MCP23017 chip. The pin values are drawn on top of this, starting at DELTA_Y.
+STATIC_CHIP = (
+  '                    +-------v-------+        ',
+  '                    ![o] MCP23017   !        ',
+  '             GPB0 <=+ 01         28 +=> GPA7         ',
+  '                    !               !        ',
+  '             GPB1 <=+ 02         27 +=> GPA6         ',
+  '                    !               !        ',
+  '             GPB2 <=+ 03         26 +=> GPA5         ',
+  '                    !               !        ',
+  '             GPB3 <=+ 04         25 +=> GPA4         ',
+  '                    !               !        ',
+  '             GPB4 <=+ 05         24 +=> GPA3         ',
+  '                    !               !        ',
+  '             GPB5 <=+ 06         23 +=> GPA2         ',
+  '                    !               !        ',
+  '             GPB6 <=+ 07         22 +=> GPA1         ',
+  '                    !               !        ',
+  '             GPB7 <=+ 08         21 +=> GPA0         ',
+  '                    !               !        ',
+  '         3.3V VDD <=+ 09         20 +=> INTA  GND',
+  '                    !               !        ',
+  '         GND  VSS <=+ 10         19 +=> INTB  GND',
+  '                    !               !        ',
+  '              N/C <=+ 11         18 +=> /RESET',
+  '                    !               !        ',
+  '              SCK <=+ 12         17 +=> A2       ',
+  '                    !               !        ',
+  '              SDA <=+ 13         16 +=> A1       ',
+  '                    !               !        ',
+  '              N/C <=+ 14         15 +=> A0       ',
+  '                    +---------------+  ',
+  '',
+  )
+
 # Acceptable Commands for controlling the I2C bus
 # These are the commands you need to use to control the DIR register of the MCP23017, or
 # for setting and clearing pins.
@@ -33,6 +73,8 @@ GETIOPIN = "GETPIN"           # Read the specific IO pin value
 GETIOREGISTER = "GETIOREG"    # Read the full IO register (low:1 or high:2)
 SETDATAPIN = "SETPIN"         # Set pin to High
 CLEARDATAPIN = "CLRPIN"       # Set pin to low
+SETDATAPINS = "SETPINS"       # Set all pins of a 16-bit mask to High (bit 0 = GPA0, bit 15 = GPB7)
+CLEARDATAPINS = "CLRPINS"     # Set all pins of a 16-bit mask to Low (bit 0 = GPA0, bit 15 = GPB7)
 
 # The COMMAND_TIMEOUT value is the maximum time (in seconds) that is allowed between pushing a  
 # button and the action that must follow. This is done to protect you from delayed actions 
@@ -47,32 +89,110 @@ CLEARDATAPIN = "CLRPIN"       # Set pin to low
 # you can can experience strange behaviour if there is a lot of latency on the bus.
 COMMAND_TIMEOUT = 1.5
 
+# Commands are pushed on the command queue of the server, a list in the Commands database, as JSON text
+# [id, timestamp, command, board, pin]. The server is waiting on this list, and picks up the commands in the 
+# same order. The name must be the same as in the mcp23017server.
+COMMAND_QUEUE = "commands:queue"
+# Every CommandsBroker gets a unique number from this counter in the Responses database. The command ids are
+# made of this number and a sequence number, so that no two clients can ever use the same command id.
+CLIENT_COUNTER = "clients:counter"
+# Lua script that pushes a batch of commands on the command queue. Redis runs the script as a single command.
+# KEYS[1] is the command queue, ARGV[1] is the expiration, followed by the commands.
+SUBMIT_LUA = """
+for i = 2, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return #ARGV - 1
+"""
+
+# Commands for which no response is needed (e.g. setting a pin after a mouse click) are queued, and
+# sent to the server in one go every QUEUE_FLUSH_INTERVAL seconds by a background thread.
+QUEUE_FLUSH_INTERVAL = 0.02
+
 # MCP23017 default parameters are that you can address the devices in the 0x20 to 0x2F 
 # address space with the three selector pins. You can change these if you want to use 
 # the software for other I2C devices.
 MINBOARDID = 0x20        # Minimum I2C address for MCP23017
 MAXBOARDID = 0x27        # Maximum I2C address for MCP23017
 
+# The labels that are shown for each board: the hexadecimal Board ID and the binary value of the address pins.
+BID_LABEL = {}
+# The status messages for each board: found or not found on the I2C bus.
+BID_FOUND = {}
+for board_id in range(MINBOARDID, MAXBOARDID + 1):
+    BID_LABEL[board_id] = ('0x{:02X}'.format(board_id), '{:03b}'.format(board_id - 0x20))
+    BID_FOUND[board_id] = {True:'    MCP23017 0x{:02X} found on I2C'.format(board_id), 
+                           False:'    MCP23017 0x{:02X} not found on I2C'.format(board_id)}
+
+# Next to the response record, the server pushes every response on a list in the Responses database.
+# Waiting for a response is then a blocking read on that list, instead of polling for the response record.
+REPLY_LIST = "{}:reply"
+# Redis versions before 6.0 only accept whole seconds as time-out for the blocking read. The last part of
+# COMMAND_TIMEOUT that is shorter than a second is waited in steps of REPLY_POLL_INTERVAL seconds instead.
+REPLY_POLL_INTERVAL = 0.05
+
+# The server returns data values as decimal (e.g. '255') or hexadecimal (e.g. '0xFF') text. All byte values
+# are converted once here, so that parsing a response is a single dictionary lookup.
+RESPONSE_VALUES = {}
+for value in range(0x100):
+    RESPONSE_VALUES['{}'.format(value)] = value
+    RESPONSE_VALUES['0x{:02X}'.format(value)] = value
+    RESPONSE_VALUES['0x{:02x}'.format(value)] = value
+
+# The colors that are used for drawing. The actual color pairs can only be looked up once curses
+# has been started, so these are filled in by WrappedDraw.
+COLOR_ON = 0      # Green: high values and input pins
+COLOR_OFF = 0     # Red: low values and output pins
+COLOR_Z = 0       # Default color: unknown values
+
 class CommandsBroker:
   """
   The CommandsBroker class is the communication line to the mcp23017server. Communications are done through the Redis database pipe.
   """
+  # Connection pools are shared by all CommandsBroker instances of the program, one pool per Redis database.
+  _connection_pools = {}
+
   def __init__(self):
-    # Commands have id   datetime.now().strftime("%d-%b-%Y %H:%M:%S.%f")}, i.e. the primary key is a timestamp. 
-    # Commands given at exactly the same time, will overwrite each other, but this is not expected to happen.
-    # The commands table is then formatted as (all fields are TEXT, even if formatted as "0xff" !!)
-    # id, command TEXT, boardnr TEXT DEFAULT '0x00', pinnr TEXT DEFAULT '0x00', datavalue TEXT DEFAULT '0x00'
+    # Commands have an id made of the client number (from CLIENT_COUNTER) and a sequence number, e.g. '12-345', so
+    # that no two commands get the same id. They are pushed on the command queue as JSON text
+    # [id, timestamp, command, board, pin], where the timestamp is the time.time() at which the command was sent.
+    # Older clients write a record per command instead, with the time.time() of the command as id, and the fields
+    # command TEXT, boardnr TEXT DEFAULT '0x00', pinnr TEXT DEFAULT '0x00', datavalue TEXT DEFAULT '0x00'
     self._commands = None
-    # Responses have id   datetime.now().strftime("%d-%b-%Y %H:%M:%S.%f")}, i.e. the primary key is a timestamp. 
-    # The Responses table is then formatted as (all fields are TEXT, even if formatted as "0xff" !!)
-    # id, command_id TEXT, datavalue TEXT, response TEXT
+    # Responses have the same id as the command they answer. The Responses table is then formatted as 
+    # (all fields are TEXT, even if formatted as "0xff" !!) id, command_id TEXT, datavalue TEXT, response TEXT
+    # The response is also pushed on the reply list of the command (REPLY_LIST), on which the client is waiting.
     self._responses = None
+    # The unique number of this client, and the sequence number of the last command id that was handed out.
+    self._client_nr = 0
+    self._last_seq = 0
+    # Commands that are queued for sending, without waiting for a response.
+    self._outbox = []
+    # Commands are sent from the main thread and from the flush thread. The lock keeps the ids and
+    # the order in which the commands arrive in the database consistent.
+    self._send_lock = Lock()
     self.errormessage = self.OpenAndVerifyDatabase()
     if (self.errormessage == ""):
       self.RedisDBInitialized = True
+      # The flush thread is a daemon, so that it doesn't keep the program alive when stopping.
+      Thread(target=self.FlushThread, daemon=True).start()
     else:
       self.RedisDBInitialized = False
 
+  @classmethod
+  def GetConnectionPool(cls, db):
+      """
+      Returns the connection pool for a Redis database, and creates it at first use. Redis selects the database 
+      per connection, so the Commands and Responses databases cannot share a single pool.
+      """
+      if db not in cls._connection_pools:
+          if (REDIS_SOCKET != '') and os.path.exists(REDIS_SOCKET):
+              cls._connection_pools[db] = redis.ConnectionPool(connection_class=redis.UnixDomainSocketConnection, path=REDIS_SOCKET, db=db)
+          else:
+              cls._connection_pools[db] = redis.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=db)
+      return cls._connection_pools[db]
+
   def OpenAndVerifyDatabase(self):
       """
       Opens an existing database, or creates a new one if not yet existing. Then 
@@ -83,106 +203,212 @@ class CommandsBroker:
           # Open the shared memory databases.
           # Redis database [0] is for commands that are sent from the clients to the server.
           nowTrying = "Commands"
-          self._commands = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+          self._commands = redis.StrictRedis(connection_pool=self.GetConnectionPool(0))
+          # The script is sent with EVALSHA. Redis-py loads the script itself if Redis does not know it (yet).
+          self._submit_script = self._commands.register_script(SUBMIT_LUA)
           # Redis database [1] is for responses from the server so the clients.
           nowTrying = "Responses"
-          self._responses = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=1)
+          self._responses = redis.StrictRedis(connection_pool=self.GetConnectionPool(1))
       except OSError as err:
           # Capturing OS error.
           return "FATAL OS ERROR. Could not open [{}] database. This program is now exiting with error [{}].".format(nowTrying, err)
-      except:
+      except Exception as err:
           # Capturing all other errors.
-          return "FATAL UNEXPECTED ERROR. Could not open [{}] database. This program is now exiting with error [{}].".format(nowTrying, sys.exc_info()[0])
+          return "FATAL UNEXPECTED ERROR. Could not open [{}] database. This program is now exiting with error [{}].".format(nowTrying, err)
       
       # Do a dummy write to the Commands database, as verification that the database is fully up and running.
       try:
           # Remember: fields are 
           #    id, command TEXT, boardnr TEXT DEFAULT '0x00', pinnr TEXT DEFAULT '0x00', datavalue TEXT DEFAULT '0x00'
-          id =  (datetime.now() - datetime.utcfromtimestamp(0)).total_seconds()
+          id = time.time()
           datamap = {'command':'dummycommand', 'boardnr':0x00, 'pinnr':0xff, 'datavalue':0x00}
-          # Write the info to the Redis database
-          self._commands.hset(id, None, None, datamap)
-          # Set expiration to 1 second, after which Redis will automatically delete the record
-          self._commands.expire(id, 1)
-      except:
-          # Capturing all errors.
-          return "FATAL UNEXPECTED ERROR. Could not read and/or write the [Commands] database. This program is now exiting with error [{}].".format(sys.exc_info()[0])
+          # Write the info to the Redis database, and set expiration to 1 second, after which Redis will 
+          # automatically delete the record. Both are sent in one round-trip through a pipeline.
+          pipe = self._commands.pipeline(transaction=False)
+          pipe.hset(id, mapping=datamap)
+          pipe.expire(id, 1)
+          pipe.execute()
+      except redis.RedisError as err:
+          # Capturing all database errors.
+          return "FATAL UNEXPECTED ERROR. Could not read and/or write the [Commands] database. This program is now exiting with error [{}].".format(err)
 
       # Next, do a dummy write to the Responses database, as verification that the database is fully up and running.
       try:
           # Remember: fields are 
           #    id, command_id TEXT, datavalue TEXT, response TEXT
-          id =  (datetime.now() - datetime.utcfromtimestamp(0)).total_seconds()
+          id = time.time()
           datamap = {'datavalue':0x00, 'response':'OK'}
-          # Write the info to the Redis database
-          self._responses.hset(id, None, None, datamap)
-          # Set expiration to 1 second, after which Redis will automatically delete the record
-          self._responses.expire(id, 1)
-      except:
-          # Capturing all errors.
-          return "FATAL UNEXPECTED ERROR. Could not read and/or write the [Responses] database. This program is now exiting with error [{}].".format(sys.exc_info()[0])
+          # Write the info to the Redis database, and set expiration to 1 second, after which Redis will 
+          # automatically delete the record. Both are sent in one round-trip through a pipeline.
+          pipe = self._responses.pipeline(transaction=False)
+          pipe.hset(id, mapping=datamap)
+          pipe.expire(id, 1)
+          pipe.execute()
+      except redis.RedisError as err:
+          # Capturing all database errors.
+          return "FATAL UNEXPECTED ERROR. Could not read and/or write the [Responses] database. This program is now exiting with error [{}].".format(err)
+
+      # Get the unique client number for the command ids.
+      try:
+          self._client_nr = self._responses.incr(CLIENT_COUNTER)
+      except redis.RedisError as err:
+          # Capturing all database errors.
+          return "FATAL UNEXPECTED ERROR. Could not get a client number from the [Responses] database. This program is now exiting with error [{}].".format(err)
       # We got here, so return zero error message.
       return ""
 
+  def NewCommandId(self):
+      """
+      Prepare a new id from the unique client number and the next sequence number (e.g. '12-345'). Unlike a 
+      timestamp, two commands can never get the same id, not even when sent at the same time by different clients.
+      """
+      self._last_seq += 1
+      return "{}-{}".format(self._client_nr, self._last_seq)
+
   def SendCommand(self, whichCommand, board_id, pin_id = 0x00):
       """
-      Send a new command to the mcp23017server through a Redis database record.
+      Send a new command to the mcp23017server by pushing it on the command queue in the Redis database.
       The commands will get a time-out, to avoid that e.g. a button pushed now, is only processed hours later.
       Response times are expected to be in the order of (fractions of) seconds.
       """
-      # Prepare new id based on timestamp. Since this is up to the milliseconds, the ID is expected to be unique
-      id = (datetime.now() - datetime.utcfromtimestamp(0)).total_seconds()
-      # Create data map
-      mapping = {'command':whichCommand, 'boardnr':board_id, 'pinnr':pin_id}
+      return self.SendCommandsBatch([(whichCommand, board_id, pin_id)])[0]
+
+  def SendCommandsBatch(self, commands):
+      """
+      Send a list of (command, board_id, pin_id) tuples to the mcp23017server in a single round-trip to the
+      Redis database. Returns the list of command ids, in the same order as the commands.
+      Queued commands are sent along in front of the new ones, so that the server processes them first.
+      """
       # Expiration in the Redis database can be set already. Use the software expiration with some grace period.
       # Expiration must be an rounded integer, or Redis will complain.
       expiration = round(COMMAND_TIMEOUT + 1)
-      # Now send the command to the Redis in-memory database
-      self._commands.hset(id, None, None, mapping)
-      # Command must self-delete within the expiration period. Redis can take care.
-      self._commands.expire(id, expiration)
-      # The timestamp is also the id of the command (needed for listening to the response)
-      return id
+      ids = []
+      args = [expiration]
+      with self._send_lock:
+          queued = self._outbox
+          self._outbox = []
+          for whichCommand, board_id, pin_id in queued + list(commands):
+              id = self.NewCommandId()
+              ids.append(id)
+              args.append(json.dumps([id, time.time(), whichCommand, board_id, pin_id]))
+          # All commands are pushed by the submit script in a single round-trip. If the server doesn't pick them
+          # up within the expiration period, Redis deletes the queue, and the server throws away old commands too.
+          if len(ids) > 0:
+              self._submit_script(keys=[COMMAND_QUEUE], args=args)
+      # The ids of the new commands are needed for listening to their responses. The queued commands get no response.
+      return ids[len(queued):]
+
+  def QueueCommand(self, whichCommand, board_id, pin_id = 0x00):
+      """
+      Queue a command for which no response is needed. The command is sent with the next batch of commands,
+      or by the flush thread within QUEUE_FLUSH_INTERVAL seconds.
+      """
+      with self._send_lock:
+          self._outbox.append((whichCommand, board_id, pin_id))
+
+  def FlushCommands(self):
+      """
+      Send all queued commands to the mcp23017server.
+      """
+      if len(self._outbox) > 0:
+          self.SendCommandsBatch([])
+
+  def FlushThread(self):
+      """
+      Background thread that regularly sends the queued commands to the mcp23017server.
+      """
+      while True:
+          sleep(QUEUE_FLUSH_INTERVAL)
+          try:
+              self.FlushCommands()
+          except Exception:
+              # The database may be temporarily unavailable. The commands are lost, but the thread must survive.
+              pass
+
+  def ParseResponse(self, datafetch):
+      """
+      Converts a response record from the Redis database into a (datavalue, response) tuple.
+      """
+      # Do data verification, to cover for crippled data entries without crashing the software.
+      try:
+          datavalue = datafetch[b'datavalue'].decode('ascii')
+      except (KeyError, TypeError, AttributeError, UnicodeDecodeError):
+          datavalue = 0x00
+
+      try:
+          response = datafetch[b'response'].decode('ascii')
+      except (KeyError, TypeError, AttributeError, UnicodeDecodeError):
+          response = "Error Parsing mcp23017server data."
+      return (datavalue, response)
 
   def WaitForReturn(self, command_id):
       """
       Wait for a response to come back from the mcp23017server, once the command has been processed on the
       I2C bus. If the waiting is too long (> COMMAND_TIMEOUT), cancel the operation and return an error.
       """
-      answer = None
+      return self.WaitForReturnBatch([command_id])[0]
+
+  def ParseReply(self, reply):
+      """
+      Converts a reply that was pushed on a reply list into a (datavalue, response) tuple.
+      """
+      # Do data verification, to cover for crippled data entries without crashing the software.
+      try:
+          datavalue, response = json.loads(reply.decode('ascii'))
+      except (ValueError, TypeError, AttributeError):
+          datavalue, response = (0x00, "Error Parsing mcp23017server data.")
+      return (datavalue, response)
+
+  def WaitForReturnBatch(self, command_ids):
+      """
+      Wait for the responses of a list of commands. The wait is a blocking read on the reply lists of all 
+      outstanding commands, so no CPU is burnt while the server is processing. Returns the list of 
+      (datavalue, response) tuples, in the same order as the command ids. Responses that did not come back 
+      within COMMAND_TIMEOUT get a time-out error.
+      """
+      answers = [None] * len(command_ids)
+      pending = {REPLY_LIST.format(command_id): i for i, command_id in enumerate(command_ids)}
       # If no timely answer, then cancel anyway. So, keep track of when we started.
-      checking_time = datetime.now()
-      while answer == None:
-          # request the data from the Redis database, based on the Command ID.
-          datafetch = self._responses.hgetall(command_id)
-          # Verify if a response is available.
-          if len(datafetch) > 0:
-              # Do data verification, to cover for crippled data entries without crashing the software.
-              try:
-                  datavalue = datafetch[b'datavalue'].decode('ascii')
-              except:
-                  datavalue = 0x00
-
-              try:
-                  response = datafetch[b'response'].decode('ascii')
-              except:
-                  response = "Error Parsing mcp23017server data."
-
-              answer = (datavalue, response)
-          if (datetime.now() - checking_time).total_seconds()  > COMMAND_TIMEOUT:
-              answer = (0x00, "Time-out error trying to get result from server for Command ID {}".format(command_id))
-      return answer
+      # The monotonic clock is used, so that a clock adjustment doesn't change the time-out.
+      checking_time = time.monotonic()
+      time_left = COMMAND_TIMEOUT
+      while (len(pending) > 0) and (time_left > 0):
+          if time_left >= 1:
+              # Block for the whole seconds that are left. A time-out of 0 would block forever.
+              reply = self._responses.blpop(list(pending.keys()), timeout=int(time_left))
+              if reply is not None:
+                  i = pending.pop(reply[0].decode('ascii'))
+                  answers[i] = self.ParseReply(reply[1])
+          else:
+              # Less than a second left. Wait a little, then take the replies that came in, in one round-trip.
+              sleep(min(time_left, REPLY_POLL_INTERVAL))
+              keys = list(pending.keys())
+              pipe = self._responses.pipeline(transaction=False)
+              for key in keys:
+                  pipe.lpop(key)
+              for key, reply in zip(keys, pipe.execute()):
+                  if reply is not None:
+                      answers[pending.pop(key)] = self.ParseReply(reply)
+          time_left = COMMAND_TIMEOUT - (time.monotonic() - checking_time)
+      # Servers that do not push the reply lists only leave the response records behind.
+      if len(pending) > 0:
+          pipe = self._responses.pipeline(transaction=False)
+          for i in pending.values():
+              pipe.hgetall(command_ids[i])
+          datafetches = pipe.execute()
+          for i, datafetch in zip(pending.values(), datafetches):
+              # Verify if a response is available.
+              if len(datafetch) > 0:
+                  answers[i] = self.ParseResponse(datafetch)
+              else:
+                  answers[i] = (0x00, "Time-out error trying to get result from server for Command ID {}".format(command_ids[i]))
+      return answers
 
-  def ProcessCommand(self, whichCommand, board_id, pin_id = 0x00):
+  def ResponseToValue(self, response, board_id, pin_id):
       """
-      The ProcessCommand function is a combination of sending the Command to the mcp23017server host, and 
-      waiting for the respone back.
+      Converts a (datavalue, response) tuple into the value returned by ProcessCommand.
       """
       retval = -1
-      # First send the command to the server
-      command_id = self.SendCommand(whichCommand, board_id, pin_id)
-      # Then wait for the response back
-      response = self.WaitForReturn(command_id)
       # A good command will result in an "OK" to come back from the server.
       if response[1].strip().upper() == 'OK':
           # OK Received, now process the data value that was sent back.
@@ -192,17 +418,36 @@ class CommandsBroker:
                   retval = 0x00
               else:
                   try:
-                      if 'x' in retval:
-                          retval = int(retval, 16)
+                      if retval in RESPONSE_VALUES:
+                          retval = RESPONSE_VALUES[retval]
                       else:
-                          retval = int(retval, 10)
-                  except:
+                          # Not a byte value, the base is derived from the prefix (0x for hexadecimal).
+                          retval = int(retval, 0)
+                  except (ValueError, TypeError):
                       # wrong type of data received
                       retval = "Error when processing return value. Received value that I could not parse: [{}]".format(response[0])
       else:
           retval = "Error when processing pin '0x{:02X}' on board '0x{:02X}'. Error Received: {}".format(board_id, pin_id, response[1])
       return retval
 
+  def ProcessCommand(self, whichCommand, board_id, pin_id = 0x00):
+      """
+      The ProcessCommand function is a combination of sending the Command to the mcp23017server host, and 
+      waiting for the respone back.
+      """
+      return self.ProcessCommandsBatch([(whichCommand, board_id, pin_id)])[0]
+
+  def ProcessCommandsBatch(self, commands):
+      """
+      Sends a list of (command, board_id, pin_id) tuples to the mcp23017server host in one go, and then waits
+      for all the responses to come back. Returns the list of values, in the same order as the commands.
+      """
+      # First send the commands to the server
+      command_ids = self.SendCommandsBatch(commands)
+      # Then wait for the responses back
+      responses = self.WaitForReturnBatch(command_ids)
+      return [self.ResponseToValue(response, board_id, pin_id) for response, (_, board_id, pin_id) in zip(responses, commands)]
+
 ################################################################################################
 rdb = CommandsBroker()
 ################################################################################################
@@ -218,9 +463,14 @@ class mcp23017addrpin:
     self._hpos = DELTA_X + 45
     self._vpos = DELTA_Y + v_position
     self.pin_number = mcp_pin_number
+    # The value that is currently on the screen, to avoid re-drawing pins that did not change.
+    self._drawn = None
 
   def draw(self, canvas):
-    canvas.addstr(self._vpos, self._hpos, '[{}]'.format(self.pinval), curses.color_pair(3) if (self.pinval == '1') else curses.color_pair(2))
+    if self._drawn == self.pinval:
+      return
+    self._drawn = self.pinval
+    canvas.addstr(self._vpos, self._hpos, '[{}]'.format(self.pinval), COLOR_ON if (self.pinval == '1') else COLOR_OFF)
 
   def EvaluateClick(self, mouse_x, mouse_y, board_id):
     if (self._vpos == mouse_y):
@@ -243,32 +493,41 @@ class mcp23017datapin:
     self._leftright = left_or_right
     self._hpos = DELTA_X
     self._vpos = DELTA_Y + v_position
+    # The positions of the pin Direction and the pin Value don't change, so calculate them only once.
+    if self._leftright == 'L':
+      self._hdirpos = self._hpos + 7
+      self._hvalpos = self._hpos + 3
+    else:
+      self._hdirpos = self._hpos + 45
+      self._hvalpos = self._hpos + 51
     self.pin_number = mcp_pin_number
+    # The direction and value that are currently on the screen, to avoid re-drawing pins that did not change.
+    self._drawn = None
 
   def draw(self, canvas):
-    if self._leftright == 'L':
-      hdirpos = self._hpos + 7
-      hvalpos = self._hpos + 3
-    else:
-      hdirpos = self._hpos + 45
-      hvalpos = self._hpos + 51
+    if self._drawn == (self.pindir, self.pinval):
+      return
+    self._drawn = (self.pindir, self.pinval)
+    addstr = canvas.addstr
+    vpos = self._vpos
+    hvalpos = self._hvalpos
 
     # Note that the pin Direction (IN or OUT) are 'drawn' with [xx] to denote that the can be changed by clicking on them.
     # The Pin Value is set to [x] in case the pin direction is 'OUT'. An input is read from the I2C bus.
     # Zero pinval values and 'OUT' pin direction values are shown in red.
-    canvas.addstr(self._vpos, hdirpos, '[{}]'.format(self.pindir), curses.color_pair(3) if (self.pindir == ' IN') else curses.color_pair(2))
+    addstr(vpos, self._hdirpos, '[{}]'.format(self.pindir), COLOR_ON if (self.pindir == ' IN') else COLOR_OFF)
     if self.pinval == '0':
       if self.pindir == ' IN':
-        canvas.addstr(self._vpos, hvalpos, ' {} '.format(self.pinval), curses.color_pair(2))
+        addstr(vpos, hvalpos, ' {} '.format(self.pinval), COLOR_OFF)
       else:
-        canvas.addstr(self._vpos, hvalpos, '[{}]'.format(self.pinval), curses.color_pair(2))
+        addstr(vpos, hvalpos, '[{}]'.format(self.pinval), COLOR_OFF)
     elif self.pinval == '1':
       if self.pindir == ' IN':
-        canvas.addstr(self._vpos, hvalpos, ' {} '.format(self.pinval), curses.color_pair(3))
+        addstr(vpos, hvalpos, ' {} '.format(self.pinval), COLOR_ON)
       else:
-        canvas.addstr(self._vpos, hvalpos, '[{}]'.format(self.pinval), curses.color_pair(3))
+        addstr(vpos, hvalpos, '[{}]'.format(self.pinval), COLOR_ON)
     else:
-      canvas.addstr(self._vpos, hvalpos, ' {} '.format(self.pinval), curses.color_pair(0))
+      addstr(vpos, hvalpos, ' {} '.format(self.pinval), COLOR_Z)
 
   def EvaluateClick(self, mouse_x, mouse_y, board_id):
     if (self._vpos == mouse_y):
@@ -281,10 +540,10 @@ class mcp23017datapin:
         if (ref_x >= 0) and (ref_x <= 4):
           if (self.pinval == '1'):
             self.pinval = '0'
-            rdb.SendCommand("CLRPIN", board_id, self.pin_number)
+            rdb.QueueCommand("CLRPIN", board_id, self.pin_number)
           else:
             self.pinval = '1'
-            rdb.SendCommand("SETPIN", board_id, self.pin_number)
+            rdb.QueueCommand("SETPIN", board_id, self.pin_number)
       # Evaluate if [Pin] clicked
       if (self._leftright == 'L'):
         ref_x = mouse_x - 7
@@ -294,11 +553,11 @@ class mcp23017datapin:
         if (self.pindir == ' IN'):
           self.pindir = 'OUT'
           self.pinval = '0'
-          rdb.SendCommand("CLRDBIT", board_id, self.pin_number)
-          rdb.SendCommand("CLRPIN", board_id, self.pin_number)
+          rdb.QueueCommand("CLRDBIT", board_id, self.pin_number)
+          rdb.QueueCommand("CLRPIN", board_id, self.pin_number)
         else:
           self.pindir = ' IN'
-          rdb.SendCommand("SETDBIT", board_id, self.pin_number)
+          rdb.QueueCommand("SETDBIT", board_id, self.pin_number)
 
 class mcp23017:
   def __init__(self):
@@ -322,10 +581,24 @@ class mcp23017:
     self._pins.append(mcp23017datapin('R', 12,  2, 'GPA2'))
     self._pins.append(mcp23017datapin('R', 14,  1, 'GPA1'))
     self._pins.append(mcp23017datapin('R', 16,  0, 'GPA0'))
+    # Keep the data pins apart, these are the ones that are scanned on the I2C bus.
+    self._datapins = list(self._pins)
+    # The directions (1 = input) and values of the data pins of the last scan, in the order of _datapins.
+    # Comparing a new scan with these arrays tells in one go if anything has to be updated.
+    self._scanned_dirs = None
+    self._scanned_vals = None
 
     self._pins.append(mcp23017addrpin(24, 17, 'A2'))
     self._pins.append(mcp23017addrpin(26, 16, 'A1'))
     self._pins.append(mcp23017addrpin(28, 15, 'A0'))
+    # Keep the address pins at hand, these determine the Board ID.
+    self._a2 = self._pins[-3]
+    self._a1 = self._pins[-2]
+    self._a0 = self._pins[-1]
+    # Group the pins per screen line, so that a mouse click only has to be evaluated by the pins on that line.
+    self._pins_by_vpos = {}
+    for aPin in self._pins:
+      self._pins_by_vpos.setdefault(aPin._vpos, []).append(aPin)
     
     # All possible MCP23017 boards on the I2C can go from 0x20 to 0x27
     self._boards = []
@@ -334,69 +607,103 @@ class mcp23017:
     self.boardsfound = {}
 
   def DrawPins(self, canvas):
-    # Draw the value of each individual pin
+    # Draw the value of each individual pin. Pins that did not change since the last draw are skipped.
     for aPin in self._pins:
       aPin.draw(canvas)
 
-  def ProcessMouseClick(self, canvas, mouse_x, mouse_y):
+  def ForceRedraw(self):
+    # Forget what is on the screen, so that all pins are drawn again at the next DrawPins.
     for aPin in self._pins:
+      aPin._drawn = None
+    self._scanned_dirs = None
+    self._scanned_vals = None
+
+  def ProcessMouseClick(self, canvas, mouse_x, mouse_y):
+    for aPin in self._pins_by_vpos.get(mouse_y, ()):
       aPin.EvaluateClick(mouse_x, mouse_y, self.board_id)
       aPin.draw(canvas)
+    # The pins may now differ from the last scan, so make sure the next scan updates all pins.
+    self._scanned_dirs = None
+    self._scanned_vals = None
     # Evaluate if one of the Address pins has been clicked. If so, change the Board_ID to the new value.
-    self.board_id = 0x20
-    for aPin in self._pins:
-      if (aPin.name == 'A0') and (aPin.pinval == '1'):
-        self.board_id += 1
-      if (aPin.name == 'A1') and (aPin.pinval == '1'):
-        self.board_id += 2
-      if (aPin.name == 'A2') and (aPin.pinval == '1'):
-        self.board_id += 4
+    self.board_id = 0x20 | (self._a0.pinval == '1') | ((self._a1.pinval == '1') << 1) | ((self._a2.pinval == '1') << 2)
   
   def BoardIsOnI2C(self, board_id):
-      retval = rdb.ProcessCommand("IDENTIFY", board_id, 0x00)
-      # Verify in inputs are given as hex. Convert to int if so
-      if(isinstance(retval,str)):
-          retval = int(retval, 16)
-      else:
-          retval = int(retval)
-      if retval == 1:
-        return True
-      else:
-        return False
+      # ProcessCommand already converts the data value to an int. Errors come back as a string, which is not 1 either.
+      return rdb.ProcessCommand("IDENTIFY", board_id, 0x00) == 1
 
   def ScanBoards(self):
     # Scan which boards can be found on the I2C bus
+    # All boards are probed in one burst of commands, instead of waiting for each board separately.
     self.boardsfound.clear()
-    for board_id in self._boards:
-      if rdb.ProcessCommand("IDENTIFY", board_id, 0x00) == 1:
+    results = rdb.ProcessCommandsBatch([("IDENTIFY", board_id, 0x00) for board_id in self._boards])
+    for board_id, result in zip(self._boards, results):
+      if result == 1:
         self.boardsfound[board_id] = 'UP'
       else:
         self.boardsfound[board_id] = '--'
 
   def ScanPins(self):
-    # Scan the pins of the active MCP23017, but only do this for the address pins.
-    for aPin in self._pins:
-      if aPin.name not in ('A0', 'A1', 'A2'):
-        # Get the Direction (IN or OUT) of the pin
-        if (rdb.ProcessCommand("GETDBIT", self.board_id, aPin.pin_number) == 1):
-          aPin.pindir = ' IN'
-        else:
-          aPin.pindir = 'OUT'
-        # Get the value of the pin (Hi/1 or Lo/0)
-        if (rdb.ProcessCommand("GETPIN", self.board_id, aPin.pin_number) == 1):
-          aPin.pinval = '1'
-        else:
-          aPin.pinval = '0'
+    # Scan the pins of the active MCP23017, but only do this for the data pins.
+    # The Direction (IN or OUT) and the value (Hi/1 or Lo/0) of all pins are requested in one burst of commands.
+    commands = [("GETDBIT", self.board_id, aPin.pin_number) for aPin in self._datapins]
+    commands += [("GETPIN", self.board_id, aPin.pin_number) for aPin in self._datapins]
+    # Returns True if any of the pins changed since the last scan.
+    results = rdb.ProcessCommandsBatch(commands)
+    numpins = len(self._datapins)
+    dirs = bytearray(dirbit == 1 for dirbit in results[:numpins])
+    vals = bytearray(pinval == 1 for pinval in results[numpins:])
+    if (dirs == self._scanned_dirs) and (vals == self._scanned_vals):
+      return False
+    self._scanned_dirs = dirs
+    self._scanned_vals = vals
+    for aPin, dirbit, pinval in zip(self._datapins, dirs, vals):
+      if (dirbit == 1):
+        aPin.pindir = ' IN'
+      else:
+        aPin.pindir = 'OUT'
+      if (pinval == 1):
+        aPin.pinval = '1'
+      else:
+        aPin.pinval = '0'
+    return True
 
 ################################################################################################
 mcp=mcp23017()
 ################################################################################################
 
+def DrawStaticPart(stdscr):
+  """
+  Draws the parts of the screen that never change: the instructions and the MCP23017 chip layout.
+  This only has to be done once, and again when the terminal was resized.
+  """
+  stdscr.clear()
+  # First draw the instruction on the screen
+  stdscr.addstr(1,  DELTA_X, 'INSTRUCTIONS:')
+  stdscr.addstr(2,  DELTA_X, '   Type [Esc]ape to stop this program.')
+  stdscr.addstr(3,  DELTA_X, '   Click on values between [brackets] to change the value.')
+  # Draw system information on the screen
+  stdscr.addstr(4,  DELTA_X, 'INFORMATION:')
+  stdscr.addstr(7,  DELTA_X, 'MCP23017 Boards found on I2C:')    
+  # Now, start drawing the graphical static part.
+  for y_pos, chip_line in enumerate(STATIC_CHIP):
+    stdscr.addstr(DELTA_Y + y_pos, DELTA_X, chip_line)
+
+def DrawStatusLine(stdscr, y_pos, text, color):
+  """
+  Replaces a single line of dynamic text, without touching the rest of the screen.
+  """
+  stdscr.move(y_pos, DELTA_X)
+  stdscr.clrtoeol()
+  stdscr.addstr(y_pos, DELTA_X, text, color)
+
 def WrappedDraw(stdscr):
   """
   Essentially this is the main routine. This routines draws the MCP23017 on the screen.
   The routine is wrapped in a curses wrapper so that the screen is not messed up after stopping
   the program. Curses can leave the screen in a very messy state otherwise.
+  The static part of the screen is drawn only once. In the loop, only lines and pins that
+  actually changed are written, and all changes are sent to the terminal in one update.
   """
   curses.curs_set(0)
   curses.mousemask(curses.ALL_MOUSE_EVENTS)
@@ -404,79 +711,77 @@ def WrappedDraw(stdscr):
   curses.use_default_colors()
   for i in range(0, curses.COLORS):
     curses.init_pair(i + 1, i, -1)
+  # Look up the color pairs only once, instead of for every pin that is drawn.
+  global COLOR_ON, COLOR_OFF, COLOR_Z
+  COLOR_ON = curses.color_pair(3)
+  COLOR_OFF = curses.color_pair(2)
+  COLOR_Z = curses.color_pair(0)
+  DrawStaticPart(stdscr)
+  # Wait at most 100ms for a key or mouse click, but return immediately when one comes in.
+  stdscr.nodelay(0)
+  stdscr.timeout(100)
+  # Keep what is on the screen, so that unchanged lines are not written again.
+  drawn_redis = None
+  drawn_board = None
+  drawn_boardsfound = None
+  # The functions that are called in every loop are looked up only once.
+  addstr = stdscr.addstr
+  getch = stdscr.getch
+  noutrefresh = stdscr.noutrefresh
+  doupdate = curses.doupdate
+  dx = DELTA_X
   mcp.key = 0
   while (mcp.key != 27):  # Key 27 is the [Esc] key.
-    stdscr.clear()
-    # First draw the instruction on the screen
-    stdscr.addstr(1,  DELTA_X, 'INSTRUCTIONS:')
-    stdscr.addstr(2,  DELTA_X, '   Type [Esc]ape to stop this program.')
-    stdscr.addstr(3,  DELTA_X, '   Click on values between [brackets] to change the value.')
     # Draw system information on the screen
-    stdscr.addstr(4,  DELTA_X, 'INFORMATION:')
-    if rdb.RedisDBInitialized:
-      stdscr.addstr(5,  DELTA_X, '    Redis database initialized.', curses.color_pair(3))
-    else:
-      stdscr.addstr(5,  DELTA_X, '    Redis database failed.', curses.color_pair(2))
-    if mcp.BoardIsOnI2C(mcp.board_id):
-      stdscr.addstr(6,  DELTA_X, '    MCP23017 0x{:02X} found on I2C'.format(mcp.board_id), curses.color_pair(3))
-    else:
-      stdscr.addstr(6,  DELTA_X, '    MCP23017 0x{:02X} not found on I2C'.format(mcp.board_id), curses.color_pair(2))    
+    if drawn_redis != rdb.RedisDBInitialized:
+      drawn_redis = rdb.RedisDBInitialized
+      if rdb.RedisDBInitialized:
+        DrawStatusLine(stdscr, 5, '    Redis database initialized.', COLOR_ON)
+      else:
+        DrawStatusLine(stdscr, 5, '    Redis database failed.', COLOR_OFF)
+    board_on_i2c = mcp.BoardIsOnI2C(mcp.board_id)
+    if drawn_board != (mcp.board_id, board_on_i2c):
+      drawn_board = (mcp.board_id, board_on_i2c)
+      DrawStatusLine(stdscr, 6, BID_FOUND[mcp.board_id][board_on_i2c], COLOR_ON if board_on_i2c else COLOR_OFF)
     # Scan the I2C bus and inform which MCP23017 devices were found on the bus.
-    stdscr.addstr(7,  DELTA_X, 'MCP23017 Boards found on I2C:')    
     mcp.ScanBoards()
-    idcntr = 4
-    for i in range (0, len(mcp.boardsfound)):
-      stdscr.addstr(8,  DELTA_X + idcntr, '0x{:02X}'.format(list(mcp.boardsfound.keys())[i]))
-      stdscr.addstr(9,  DELTA_X + idcntr, '{:03b}'.format(list(mcp.boardsfound.keys())[i] - 0x20))
-      stdscr.addstr(10,  DELTA_X + idcntr + 1, '{}'.format(list(mcp.boardsfound.values())[i]))
-      idcntr += 5
-    # Now, start drawing the graphical static part.
-    stdscr.addstr(DELTA_Y + 0,  DELTA_X, '                    +-------v-------+        ')
-    stdscr.addstr(DELTA_Y + 1,  DELTA_X, '                    ![o] MCP23017   !        ')
-    stdscr.addstr(DELTA_Y + 2,  DELTA_X, '             GPB0 <=+ 01         28 +=> GPA7         ')
-    stdscr.addstr(DELTA_Y + 3,  DELTA_X, '                    !               !        ')
-    stdscr.addstr(DELTA_Y + 4,  DELTA_X, '             GPB1 <=+ 02         27 +=> GPA6         ')
-    stdscr.addstr(DELTA_Y + 5,  DELTA_X, '                    !               !        ')
-    stdscr.addstr(DELTA_Y + 6,  DELTA_X, '             GPB2 <=+ 03         26 +=> GPA5         ')
-    stdscr.addstr(DELTA_Y + 7,  DELTA_X, '                    !               !        ')
-    stdscr.addstr(DELTA_Y + 8,  DELTA_X, '             GPB3 <=+ 04         25 +=> GPA4         ')
-    stdscr.addstr(DELTA_Y + 9,  DELTA_X, '                    !               !        ')
-    stdscr.addstr(DELTA_Y + 10, DELTA_X, '             GPB4 <=+ 05         24 +=> GPA3         ')
-    stdscr.addstr(DELTA_Y + 11, DELTA_X, '                    !               !        ')
-    stdscr.addstr(DELTA_Y + 12, DELTA_X, '             GPB5 <=+ 06         23 +=> GPA2         ')
-    stdscr.addstr(DELTA_Y + 13, DELTA_X, '                    !               !        ')
-    stdscr.addstr(DELTA_Y + 14, DELTA_X, '             GPB6 <=+ 07         22 +=> GPA1         ')
-    stdscr.addstr(DELTA_Y + 15, DELTA_X, '                    !               !        ')
-    stdscr.addstr(DELTA_Y + 16, DELTA_X, '             GPB7 <=+ 08         21 +=> GPA0         ')
-    stdscr.addstr(DELTA_Y + 17, DELTA_X, '                    !               !        ')
-    stdscr.addstr(DELTA_Y + 18, DELTA_X, '         3.3V VDD <=+ 09         20 +=> INTA  GND')
-    stdscr.addstr(DELTA_Y + 19, DELTA_X, '                    !               !        ')
-    stdscr.addstr(DELTA_Y + 20, DELTA_X, '         GND  VSS <=+ 10         19 +=> INTB  GND')
-    stdscr.addstr(DELTA_Y + 21, DELTA_X, '                    !               !        ')
-    stdscr.addstr(DELTA_Y + 22, DELTA_X, '              N/C <=+ 11         18 +=> /RESET')
-    stdscr.addstr(DELTA_Y + 23, DELTA_X, '                    !               !        ')
-    stdscr.addstr(DELTA_Y + 24, DELTA_X, '              SCK <=+ 12         17 +=> A2       ')
-    stdscr.addstr(DELTA_Y + 25, DELTA_X, '                    !               !        ')
-    stdscr.addstr(DELTA_Y + 26, DELTA_X, '              SDA <=+ 13         16 +=> A1       ')
-    stdscr.addstr(DELTA_Y + 27, DELTA_X, '                    !               !        ')
-    stdscr.addstr(DELTA_Y + 28, DELTA_X, '              N/C <=+ 14         15 +=> A0       ')
-    stdscr.addstr(DELTA_Y + 29, DELTA_X, '                    +---------------+  ')
-    stdscr.addstr(DELTA_Y + 30,  DELTA_X, '')
+    if drawn_boardsfound != mcp.boardsfound:
+      drawn_boardsfound = dict(mcp.boardsfound)
+      for y_pos in range(8, 11):
+        stdscr.move(y_pos, dx)
+        stdscr.clrtoeol()
+      idcntr = 4
+      for board_id, status in mcp.boardsfound.items():
+        hex_label, bin_label = BID_LABEL[board_id]
+        addstr(8,  dx + idcntr, hex_label)
+        addstr(9,  dx + idcntr, bin_label)
+        addstr(10,  dx + idcntr + 1, status)
+        idcntr += 5
 
     # Draw the graphical dynamic part.
-    mcp.ScanPins()
-    mcp.DrawPins(stdscr)
-    stdscr.refresh()
+    if mcp.ScanPins():
+      mcp.DrawPins(stdscr)
+    # Send all changes of this loop to the terminal at once.
+    noutrefresh()
+    doupdate()
 
-    sleep(0.1)
-    stdscr.nodelay(1)
-    mcp.key = stdscr.getch()
+    mcp.key = getch()
     if mcp.key == curses.KEY_MOUSE:
       _, mx, my, _, _ = curses.getmouse()
       mcp.ProcessMouseClick(stdscr, mx, my)
+    elif mcp.key == curses.KEY_RESIZE:
+      # The terminal may have lost its content, so redraw everything.
+      DrawStaticPart(stdscr)
+      drawn_redis = None
+      drawn_board = None
+      drawn_boardsfound = None
+      mcp.ForceRedraw()
 
 def main():
   wrapper(WrappedDraw)
+  # Don't lose the commands of the last mouse clicks.
+  if rdb.RedisDBInitialized:
+    rdb.FlushCommands()
 
 if __name__ == "__main__":
     """
@@ -6,15 +6,26 @@ Author: find me on codeproject.com --> JurgenVanGorp
 """
 import traceback
 import os
+import json
 import sys
 import time
 import logging
 import redis
-from logging.handlers import RotatingFileHandler
-import xml.etree.ElementTree as ET
-from datetime import datetime
-from smbus2 import SMBus
-from threading import Thread, Lock
+import atexit
+import signal
+from collections import deque
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from queue import SimpleQueue
+# lxml is a C library that parses and writes XML faster than the standard library. Since the API for the
+# operations used here is the same, fall back to the standard library if lxml is not installed.
+try:
+    from lxml import etree as ET
+    USE_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    USE_LXML = False
+from threading import Event, Lock, RLock, Timer
+from concurrent.futures import ThreadPoolExecutor
 
 VERSION = "1.00"
 
@@ -31,6 +42,13 @@ VERSION = "1.00"
 # CONFIGURATION_FILE = ".mcp23017control.xml" --> Default value
 # CONFIGURATION_FILE = ''  --> Set to empty string to disable this feature.
 CONFIGURATION_FILE = ".mcp23017server.xml"
+# Changes to the configuration are not written to the file immediately, but collected for XML_FLUSH_DELAY
+# seconds, after which they are written in one go. This avoids rewriting the file for every single pin change.
+XML_FLUSH_DELAY = 0.5
+# Contents of a new XML parameter file. The indentation is added when the file is written.
+EMPTY_XML_DATA = b'<DATA><i2cboards></i2cboards></DATA>'
+# Indentation per level of the parameter file, for when neither lxml nor ET.indent is available.
+XML_INDENTS = tuple("\n{}".format('  ' * level) for level in range(8))
 
 # LOG_LEVEL determines the level of logging output into the system logs.
 # Log Level = 0 --> No logging at all
@@ -60,9 +78,17 @@ GETIOPIN = "GETPIN"           # Read the specific IO pin value
 GETIOREGISTER = "GETIOREG"    # Read the full IO register (low:1 or high:2)
 SETDATAPIN = "SETPIN"         # Set pin to High
 CLEARDATAPIN = "CLRPIN"       # Set pin to low
+SETDATAPINS = "SETPINS"       # Set all pins of a 16-bit mask to High (bit 0 = GPA0, bit 15 = GPB7)
+CLEARDATAPINS = "CLRPINS"     # Set all pins of a 16-bit mask to Low (bit 0 = GPA0, bit 15 = GPB7)
 TOGGLEPIN = "TOGGLE"          # Toggle a pin to the "other" value for TOGGLEDELAY time
                               # If a pin is high, it will be set to low, and vice versa
 TOGGLEDELAY = 0.1             # Seconds that the pin will be toggled. Default = 100 msec
+TOGGLE_WORKERS = 4            # Number of threads that process the toggles, i.e. the number of pins that can be toggled at the same time
+# All accepted commands, and the error message for commands that are not accepted.
+VALID_COMMANDS = frozenset({FINDBOARD, GETIOPIN, SETDIRBIT, CLEARDIRBIT, GETDIRBIT, SETDATAPIN, CLEARDATAPIN, SETDATAPINS, CLEARDATAPINS, GETIOREGISTER, GETDIRREGISTER, TOGGLEPIN})
+# Commands that take a 16-bit pin mask instead of a single pin number.
+MASK_COMMANDS = frozenset({SETDATAPINS, CLEARDATAPINS})
+COMMAND_EXPECTATION = "Error: first command must be one of the following {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}. ".format(FINDBOARD, GETDIRBIT, GETDIRREGISTER, SETDIRBIT, CLEARDIRBIT, GETIOPIN, GETIOREGISTER, SETDATAPIN, CLEARDATAPIN, SETDATAPINS, CLEARDATAPINS, TOGGLEPIN)
 
 # The COMMAND_TIMEOUT value is the maximum time (in seconds) that is allowed between pushing a  
 # button and the action that must follow. This is done to protect you from delayed actions 
@@ -77,6 +103,19 @@ TOGGLEDELAY = 0.1             # Seconds that the pin will be toggled. Default =
 # you can can experience strange behaviour if there is a lot of latency on the bus.
 COMMAND_TIMEOUT = 1.5
 
+# When no commands are coming in, the server blocks on the command queue for at most IDLE_WAIT seconds, and 
+# is woken up by Redis as soon as a client pushes a command. Redis versions before 6.0 only accept whole seconds 
+# as BLPOP time-out, so this must be a whole number of at least 1 (0 would block forever).
+IDLE_WAIT = 1
+# Clients push their commands on the command queue, a list in the Commands database, as JSON text 
+# [id, timestamp, command, board, pin]. The timestamp is the time.time() at which the command was sent. The server does not sleep while waiting, but does a blocking read on this list,
+# so it wakes up as soon as a command comes in. 
+# Older clients write a record per command instead. These records are picked up by a sweep over all keys
+# in the Commands database. The sweep is done at most once every IDLE_WAIT seconds, whether or not commands come 
+# in on the queue, so the commands of older clients wait at most about IDLE_WAIT seconds longer.
+COMMAND_QUEUE = "commands:queue"
+COMMAND_QUEUE_KEY = COMMAND_QUEUE.encode('ascii')
+
 # Communications between Clients and the server happen through a Redis in-memory database
 # so to limit the number of writes on the (SSD or microSD) storage. For larger implementations
 # dozens to hundreds of requests can happen per second. Writing to disk would slow down the 
@@ -85,6 +124,9 @@ COMMAND_TIMEOUT = 1.5
 # environments. The default is that Redis is installed on localhost (127.0.0.1).
 REDIS_HOST = 'localhost'
 REDIS_PORT = 6379
+# If Redis is configured to listen on a Unix domain socket, this is used instead of REDIS_HOST and REDIS_PORT.
+# This avoids the TCP/IP overhead for the localhost communication. Set to an empty string to always use TCP/IP.
+REDIS_SOCKET = '/run/redis/redis-server.sock'
 
 ###
 ### PROGRAM INTERNAL CONSTANTS ####################################################################
@@ -98,9 +140,16 @@ MINBOARDID = 0x20        # Minimum I2C address
 MAXBOARDID = 0x2f        # Maximum I2C address
 MINPIN = 0x00            # Minimum pin on the MCP23017
 MAXPIN = 0x10            # Maximum pin on the MCP23017, +1 (i.e. must be lower than this value)
+MAXMASK = 0x10000        # Maximum pin mask on the MCP23017, +1 (i.e. must be lower than this value)
+# Error messages for Board IDs and pin numbers that are out of range.
+BOARD_RANGE_ERROR = "Error: Board ID not in range [0x{:0{}X}, 0x{:0{}X}]. ".format(MINBOARDID, 2, MAXBOARDID, 2)
+PIN_RANGE_ERROR = "Error: registervalue not in range [0x{:0{}X}, 0x{:0{}X}]. ".format(MINPIN, 2, MAXPIN-1, 2)
+MASK_RANGE_ERROR = "Error: pin mask not in range [0x{:0{}X}, 0x{:0{}X}]. ".format(0, 4, MAXMASK-1, 4)
 # TimeOut in seonds before the threads are considered dead. If the time-out is reached, 
 # the thread will crash and die, and is expected to be restarted as a service
 WATCHDOG_TIMEOUT = 5
+# A board that answered on the I2C bus less than PROBE_VALIDITY seconds ago is not probed again when it is identified.
+PROBE_VALIDITY = 1.0
 ### Define MCP23017 specific registers
 IODIRA = 0x00            # IO direction A - 1= input 0 = output
 IODIRB = 0x01            # IO direction B - 1= input 0 = output    
@@ -124,10 +173,49 @@ GPIOB = 0x13             # Data port B
 OLATA = 0x14             # Output latches A
 OLATB = 0x15             # Output latches B
 ALLOUTPUTS = "0xff"      # Initial value of DIR register if not yet used
+# Look-up tables that give the register and the bit mask for pin numbers 0 to 15. Pins 0 to 7 are on port A, 
+# pins 8 to 15 on port B.
+IODIR_PINS = tuple(((IODIRA if (pin_nr < 8) else IODIRB), 1 << (pin_nr & 0x07)) for pin_nr in range(16))
+GPIO_PINS = tuple(((GPIOA if (pin_nr < 8) else GPIOB), 1 << (pin_nr & 0x07)) for pin_nr in range(16))
+OLAT_PINS = tuple(((OLATA if (pin_nr < 8) else OLATB), 1 << (pin_nr & 0x07)) for pin_nr in range(16))
 
 # The dummy command is sent during initialization of the database and verification if
 # the database can be written to. Dummy commands are not processed.
 DUMMY_COMMAND = 'dummycommand'
+# Next to the response record, the response is also pushed on a list in the Responses database.
+# Clients can then do a blocking wait on that list, instead of polling for the response record.
+REPLY_LIST = "{}:reply"
+# Lua script that writes a response record and pushes the response on the reply list, both with their expiration.
+# Redis runs the script as a single command, instead of a HSET, RPUSH and two EXPIREs per response.
+# KEYS are the response id and the reply list. ARGV are the datavalue, the response, the reply and the expiration.
+REPLY_LUA = """
+redis.call('HSET', KEYS[1], 'command_id', KEYS[1], 'datavalue', ARGV[1], 'response', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('RPUSH', KEYS[2], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+"""
+# Responses are deleted automatically by Redis after this many seconds. Several seconds grace period are 
+# added to the command time-out, and the value is rounded to an integer, as needed by Redis.
+RESPONSE_EXPIRATION = round(COMMAND_TIMEOUT + 2)
+# Commands on the command queue that are older than this many seconds are thrown away, the same as Redis
+# does for the command records of the older clients.
+COMMAND_EXPIRATION = round(COMMAND_TIMEOUT + 1)
+# Formats a byte as a two-digit hex string (e.g. '0x0F'), as used in the responses and the XML file.
+# The strings of all 256 byte values are made once, so formatting a byte is a dictionary lookup. Other 
+# values (e.g. -1 when an I2C error occurred) are not in the table, and are formatted when asked.
+class HexByteTable(dict):
+    def __missing__(self, value):
+        return '0x%02X' % value
+HEX_BYTE = HexByteTable((value, '0x%02X' % value) for value in range(0x100)).__getitem__
+# The other way around: turns a hex string (e.g. '0x0F' or '0x0f') into an int. Ints are passed on unchanged. 
+# All byte values are in the table in both spellings, so the conversion is a dictionary lookup.
+class HexValueTable(dict):
+    def __missing__(self, value):
+        return int(value, 16) if isinstance(value, str) else value
+HEX_VALUE = HexValueTable(
+    [(value, value) for value in range(0x100)] +
+    [('0x%02X' % value, value) for value in range(0x100)] +
+    [('0x%02x' % value, value) for value in range(0x100)]).__getitem__
 
 ### END OF CONSTANTS SECTION #########################################################
 
@@ -138,15 +226,24 @@ class databaseHandler():
     server (0) or from server to client (1).
     """
     def __init__(self, the_log):
-        # Commands have id   datetime.now().strftime("%d-%b-%Y %H:%M:%S.%f")}, i.e. the primary key is a timestamp. 
-        # Commands given at exactly the same time, will overwrite each other, but this is not expected to happen.
-        # The commands table is then formatted as (all fields are TEXT, even if formatted as "0xff" !!)
-        # id, command TEXT, boardnr TEXT DEFAULT '0x00', pinnr TEXT DEFAULT '0x00', datavalue TEXT DEFAULT '0x00'
+        # Commands have an id made of the client number (from a counter in the Responses database) and a sequence
+        # number, e.g. '12-345', so that no two commands get the same id. They are pushed on the command queue as
+        # JSON text [id, timestamp, command, board, pin], where the timestamp is the time.time() of the command.
+        # Older clients write a record per command instead, with the time.time() of the command as id, and the fields
+        # command TEXT, boardnr TEXT DEFAULT '0x00', pinnr TEXT DEFAULT '0x00', datavalue TEXT DEFAULT '0x00'
         self._commands = None
-        # Responses have id   datetime.now().strftime("%d-%b-%Y %H:%M:%S.%f")}, i.e. the primary key is a timestamp. 
-        # The Responses table is then formatted as (all fields are TEXT, even if formatted as "0xff" !!)
-        # id, command_id TEXT, datavalue TEXT, response TEXT
+        # Responses have the same id as the command they answer. The Responses table is then formatted as 
+        # (all fields are TEXT, even if formatted as "0xff" !!) id, command_id TEXT, datavalue TEXT, response TEXT
+        # The response is also pushed on the reply list of the command (REPLY_LIST), on which the client is waiting.
         self._responses = None
+        # Commands that were fetched from the database, but are not processed yet (oldest first), as tuples of
+        # (id, command, boardnr, pinnr, datavalue).
+        # A deque is used, so that taking the oldest command doesn't shift all the others in memory.
+        self._pending = deque()
+        # Pipeline in which the responses are collected until all fetched commands are processed.
+        self._reply_pipe = None
+        # Time (time.monotonic) at which the command records of the older clients are swept for the next time.
+        self._next_sweep = 0.0
         # Copy logfile to local
         self._log = the_log
         # Initialize database
@@ -157,25 +254,35 @@ class databaseHandler():
         Opens an existing database, or creates a new one if not yet existing. Then 
         verifies if the Redis database is accessible.
         """
+        # Use the Unix domain socket if Redis provides one, TCP/IP otherwise.
+        if (REDIS_SOCKET != '') and os.path.exists(REDIS_SOCKET):
+            connection = {'unix_socket_path':REDIS_SOCKET}
+        else:
+            connection = {'host':REDIS_HOST, 'port':REDIS_PORT}
+        # Only the main thread of the server talks to Redis, so each database keeps a single connection open for 
+        # good, instead of taking a connection from the connection pool (and handing it back) at every command.
+        connection['single_connection_client'] = True
         # First try to open the database itself.
         try:
             # Open the shared memory databases.
             # Redis database [0] is for commands that are sent from the clients to the server.
             nowTrying = "Commands"
             self._log.info(1, "Opening Commands database.")
-            self._commands = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+            self._commands = redis.StrictRedis(db=0, **connection)
             # Redis database [1] is for responses from the server so the clients.
             nowTrying = "Responses"
             self._log.info(1, "Opening Responses database.")
-            self._responses = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=1)
+            self._responses = redis.StrictRedis(db=1, **connection)
+            # The script is sent with EVALSHA. Redis-py loads the script itself if Redis does not know it (yet).
+            self._reply_script = self._responses.register_script(REPLY_LUA)
         except OSError as err:
             # Capturing OS error.
-            self._log.error(1, "FATAL OS ERROR. Could not open [{}] database. This program is now exiting with error [{}].".format(nowTrying, err))
+            self._log.error(1, "FATAL OS ERROR. Could not open [%s] database. This program is now exiting with error [%s].", nowTrying, err)
             # If a database cannot be opened, this program makes no sense, so exiting.
             sys.exit(1)
-        except:
+        except Exception as err:
             # Capturing all other errors.
-            self._log.error(1, "FATAL UNEXPECTED ERROR. Could not open [{}] database. This program is now exiting with error [{}].".format(nowTrying, sys.exc_info()[0]))
+            self._log.error(1, "FATAL UNEXPECTED ERROR. Could not open [%s] database. This program is now exiting with error [%s].", nowTrying, err)
             # If a database cannot be opened, this program makes no sense, so exiting.
             sys.exit(1)
         
@@ -183,15 +290,17 @@ class databaseHandler():
         try:
             # Remember: fields are: id, command TEXT, boardnr TEXT DEFAULT '0x00', pinnr TEXT DEFAULT '0x00', datavalue TEXT DEFAULT '0x00'
             self._log.info(2, "Verifying Commands database with dummy write.")
-            id =  (datetime.now() - datetime.utcfromtimestamp(0)).total_seconds()
+            id = time.time()
             datamap = {'command':DUMMY_COMMAND, 'boardnr':0x00, 'pinnr':0xff, 'datavalue':0x00}
-            # Write the info to the Redis database
-            self._commands.hset(id, None, None, datamap)
-            # Set expiration to a short 1 second, after which Redis will automatically delete the record
-            self._commands.expire(id, 1)
-        except:
-            # Capturing all errors.
-            self._log.error(1, "FATAL UNEXPECTED ERROR. Could not read and/or write the [Commands] database. This program is now exiting with error [{}].".format(sys.exc_info()[0]))
+            # Write the info to the Redis database, and set expiration to a short 1 second, after which Redis will 
+            # automatically delete the record. Both are sent in one round-trip through a pipeline.
+            pipe = self._commands.pipeline(transaction=False)
+            pipe.hset(id, mapping=datamap)
+            pipe.expire(id, 1)
+            pipe.execute()
+        except redis.RedisError as err:
+            # Capturing all database errors.
+            self._log.error(1, "FATAL UNEXPECTED ERROR. Could not read and/or write the [Commands] database. This program is now exiting with error [%s].", err)
             # If a database cannot be processed, this program makes no sense, so exiting.
             sys.exit(1)
 
@@ -199,62 +308,153 @@ class databaseHandler():
         try:
             # Remember: fields are: id, command_id TEXT, datavalue TEXT, response TEXT
             self._log.info(2, "Verifying Responses database with dummy write.")
-            id =  (datetime.now() - datetime.utcfromtimestamp(0)).total_seconds()
+            id = time.time()
             datamap = {'datavalue':0x00, 'response':'OK'}
-            # Write the info to the Redis database
-            self._responses.hset(id, None, None, datamap)
-            # Set expiration to a short 1 second, after which Redis will automatically delete the record
-            self._responses.expire(id, 1)
-        except:
-            # Capturing all errors.
-            self._log.error(1, "FATAL UNEXPECTED ERROR. Could not read and/or write the [Responses] database. This program is now exiting with error [{}].".format(sys.exc_info()[0]))
+            # Write the info to the Redis database, and set expiration to a short 1 second, after which Redis will 
+            # automatically delete the record. Both are sent in one round-trip through a pipeline.
+            pipe = self._responses.pipeline(transaction=False)
+            pipe.hset(id, mapping=datamap)
+            pipe.expire(id, 1)
+            pipe.execute()
+        except redis.RedisError as err:
+            # Capturing all database errors.
+            self._log.error(1, "FATAL UNEXPECTED ERROR. Could not read and/or write the [Responses] database. This program is now exiting with error [%s].", err)
             # If a database cannot be processed, this program makes no sense, so exiting.
             sys.exit(1)
 
-    def GetNextCommand(self):
+    def FetchPendingCommands(self):
         """
-        Fetches the oldest command - that has not expired - from the commands buffer.
+        Fetches all commands that are waiting on the command queue at once. The queue is read and emptied in 
+        a single transaction, so that no command that comes in at the same time gets lost.
+        Once every IDLE_WAIT seconds, the command records of the older clients are fetched as well.
         """
-        # Get all keys from the Commands table
+        pipe = self._commands.pipeline()
+        pipe.lrange(COMMAND_QUEUE, 0, -1)
+        pipe.delete(COMMAND_QUEUE)
+        for item in pipe.execute()[0]:
+            self.AddQueuedCommand(item)
+        # The sweep runs on its own schedule, so that the older clients are also served while the queue is busy.
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._next_sweep = now + IDLE_WAIT
+            self.FetchCommandRecords()
+
+    def FetchCommandRecords(self):
+        """
+        Fetches all command records that are waiting in the Commands database at once. All records are read and 
+        deleted in one round-trip, instead of one KEYS, HGETALL and DEL per command.
+        """
+        # Get all keys from the Commands table. The command queue is not a command record, so leave it out.
         rkeys = self._commands.keys("*")
-        # Key IDs are based on the timestamp, so sorting will pick the oldest first
-        rkeys.sort()
-        # Check if there are keys available
+        if COMMAND_QUEUE_KEY in rkeys:
+            rkeys.remove(COMMAND_QUEUE_KEY)
         if len(rkeys) > 0:
-            # Get the first key from the list
-            id = rkeys[0]
-            # Read the Redis data
-            datarecord = self._commands.hgetall(id)
-            # We have the data, now delete the record (don't wait for the time-out)
-            self._commands.delete(id)
-            # pull the data from the record, and do proper conversions.
-            # Correct potential dirty entries, to avoid that the software crashes on poor data.
-            try:
-                return_id = float(id.decode('ascii'))
-            except:
-                return_id = 0
+            # Key IDs are based on the timestamp, so sorting will pick the oldest first
+            rkeys.sort()
+            # Read the fields that are used (in a fixed order, without building a dict per record), then delete 
+            # the records (don't wait for the time-out)
+            pipe = self._commands.pipeline(transaction=False)
+            for id in rkeys:
+                pipe.hmget(id, 'command', 'boardnr', 'pinnr')
+            pipe.delete(*rkeys)
+            datarecords = pipe.execute()[:-1]
+            for id, datarecord in zip(rkeys, datarecords):
+                # Records that expired between the KEYS and the HMGET come back without fields. Skip them.
+                if datarecord != [None, None, None]:
+                    self._pending.append(self.ParseCommandRecord(id, *datarecord))
+
+    def WaitForCommands(self, timeout):
+        """
+        Waits until a command comes in on the command queue, or until timeout seconds have passed.
+        The timeout must be a whole number of seconds, of at least 1. Returns True if a command came in.
+        The command records of the older clients are not waited for, but are picked up by FetchPendingCommands.
+        """
+        item = self._commands.blpop(COMMAND_QUEUE, timeout = timeout)
+        if item is None:
+            return False
+        self.AddQueuedCommand(item[1])
+        return True
 
-            try:
-                command =  datarecord[b'command'].decode('ascii')
-            except:
-                command = ''
+    def AddQueuedCommand(self, item):
+        """
+        Converts a command from the command queue (JSON text [id, timestamp, command, board, pin]) into a command 
+        tuple, and adds it to the pending commands. Expired commands and commands that cannot be read are thrown away.
+        """
+        try:
+            id, timestamp, command, boardnr, pinnr = json.loads(item)
+            expired = (time.time() - timestamp) > COMMAND_EXPIRATION
+        except (ValueError, TypeError):
+            self._log.info(2, "Could not read command [%s] from the command queue.", item)
+            return
+        if expired or not id:
+            return
+        # Board and pin numbers are normally sent as int, but can also be text (e.g. '0x0f').
+        # Numbers that can not be parsed become 0x00, which is then refused as out of range.
+        try:
+            if not isinstance(boardnr, int):
+                boardnr = self.ParseNumber(str(boardnr).encode('ascii'))
+        except ValueError:
+            boardnr = 0x00
 
-            try:
-                boardnr =  datarecord[b'boardnr'].decode('ascii')
-            except:
-                boardnr = 0x00
+        try:
+            if not isinstance(pinnr, int):
+                pinnr = self.ParseNumber(str(pinnr).encode('ascii'))
+        except ValueError:
+            pinnr = 0x00
+        self._pending.append((id, str(command), boardnr, pinnr, 0x00))
 
-            try:
-                pinnr =  datarecord[b'pinnr'].decode('ascii')
-            except:
-                pinnr = 0x00
+    def ParseNumber(self, raw_value):
+        """
+        Converts a number from the database (bytes) into an int. Numbers can be decimal or hexadecimal (e.g. b'0x0f').
+        """
+        if b'x' in raw_value:
+            return int(raw_value, 16)
+        else:
+            return int(raw_value, 10)
 
-            try:
-                datavalue =  datarecord[b'datavalue'].decode('ascii')
-            except:
-                datavalue = 0x00
-            # return the data read
-            return(return_id, command, boardnr, pinnr, datavalue)
+    def ParseCommandRecord(self, id, command, boardnr, pinnr):
+        """
+        Converts the (raw) fields of a command record of an older client into a command tuple. Missing fields are None.
+        """
+        # pull the data from the record, and do proper conversions.
+        # Correct potential dirty entries, to avoid that the software crashes on poor data.
+        try:
+            return_id = float(id.decode('ascii'))
+        except ValueError:
+            return_id = 0
+
+        try:
+            command =  (command or b'').decode('ascii')
+        except UnicodeDecodeError:
+            command = ''
+
+        # Board and pin numbers are converted straight from the raw bytes, without decoding to text first.
+        # Numbers that can not be parsed become 0x00, which is then refused as out of range.
+        try:
+            boardnr = self.ParseNumber(boardnr or b'0')
+        except ValueError:
+            boardnr = 0x00
+
+        try:
+            pinnr = self.ParseNumber(pinnr or b'0')
+        except ValueError:
+            pinnr = 0x00
+
+        # The datavalue field is not used by any of the commands.
+        return (return_id, command, boardnr, pinnr, 0x00)
+
+    def GetNextCommand(self):
+        """
+        Fetches the oldest command - that has not expired - from the commands buffer.
+        """
+        # Only go to the database if all previously fetched commands are processed. Their responses are sent first.
+        if len(self._pending) == 0:
+            self.FlushResponses()
+            self.FetchPendingCommands()
+        # Check if there are commands available
+        if len(self._pending) > 0:
+            # Get the first command from the list
+            return self._pending.popleft()
         else:
             # return a zero record if nothing was received
             return (0, '', 0x00, 0x00, 0x00)
@@ -266,10 +466,23 @@ class databaseHandler():
         """
         # Remember: fields are : id, command_id TEXT, datavalue TEXT, response TEXT
         # The Response ID is the same as the Command ID, making it easy for the client to capture the data.
-        mapping = {'command_id':id, 'datavalue':value, 'response':response}
-        self._responses.hset(id, None, None, mapping)
-        # set auto-delete time-out in the Redis database. Add several seconds grace period, and round to integer values
-        self._responses.expire(id, round(COMMAND_TIMEOUT + 2))
+        # The response is also pushed on the reply list, to wake up the clients that are waiting on it.
+        reply_list = REPLY_LIST.format(id)
+        # All writes are done by the reply script, with the auto-delete time-out set in the Redis database. The responses
+        # of the commands that were fetched together, are sent together in a single round-trip by FlushResponses.
+        if self._reply_pipe is None:
+            self._reply_pipe = self._responses.pipeline(transaction=False)
+        self._reply_script(keys=[id, reply_list], args=[value, response, json.dumps([value, response]), RESPONSE_EXPIRATION], 
+                           client=self._reply_pipe)
+
+    def FlushResponses(self):
+        """
+        Sends all collected responses to the Responses database.
+        """
+        if self._reply_pipe is not None:
+            pipe = self._reply_pipe
+            self._reply_pipe = None
+            pipe.execute()
 
 class mcp23017broker():
     """
@@ -285,76 +498,65 @@ class mcp23017broker():
         self._xmldata = xmldata
         # Create a data pipe to the in-memory database
         self._datapipe = databaseHandler(self._log)
+        # Table with the function that processes each command.
+        self._dispatch = {
+            GETDIRBIT: self._DoGetDirBit,
+            FINDBOARD: self._DoFindBoard,
+            GETDIRREGISTER: self._DoGetDirRegister,
+            SETDIRBIT: self._DoSetDirBit,
+            CLEARDIRBIT: self._DoClearDirBit,
+            GETIOPIN: self._DoGetIOPin,
+            GETIOREGISTER: self._DoGetIORegister,
+            SETDATAPIN: self._DoSetDataPin,
+            CLEARDATAPIN: self._DoClearDataPin,
+            SETDATAPINS: self._DoSetDataPins,
+            CLEARDATAPINS: self._DoClearDataPins,
+            TOGGLEPIN: self._DoTogglePin,
+            }
 
     def service_commands(self):
         """
         Process incoming data coming from the connected clients (one at the time).
         Properly formatted commands are processed immediately, or as separate threads (for long-lasting commands).
+        Returns True if a command was received, False if the pipe was empty.
         """
         # Fetch a command from the pipe
         command_list = self._datapipe.GetNextCommand()
-        # a command id larger than 0 is a successful read. Command ID zero is returned if the pipe is empty.
-        if command_list[0] > 0:
-            self._log.info(2, "Received command with id [{}]: [{}] for board [{}] and pin [{}].".format(str(command_list[0]), command_list[1], str(command_list[2]), str(command_list[3])))
-            # Start the reply error with an empty error
-            self._return_error = ""
+        # a command id other than 0 is a successful read. Command ID zero is returned if the pipe is empty.
+        if command_list[0]:
+            self._log.info(2, "Received command with id [%s]: [%s] for board [%s] and pin [%s].", command_list[0], command_list[1], command_list[2], command_list[3])
+            # Start with an empty list of errors. The errors are only glued together if there are any.
+            return_errors = []
             # retrieve commands from the pipe
             command_id = command_list[0]
             the_command = command_list[1]
             the_board = command_list[2]
-            the_pin = command_list[3]
             # During initialization a dummy command is sent. This is also done by the clients, so make sure that these commands are thrown away.
             if the_command != DUMMY_COMMAND:
-                # Inputs can have different formats, also numerical as hexadecimal (e.g. '0x0f'). Convert where necessary.
-                if(isinstance(the_board,str)):
-                    if 'x' in the_board:
-                        the_board = int(the_board, 16)
-                    else:
-                        the_board = int(the_board, 10)
+                # The databaseHandler always returns the command as text, and the board and pin numbers as int (0x00 if
+                # they could not be read), so the checks below cannot fail on dirty data.
                 the_value = command_list[3]
-                if(isinstance(the_value,str)):
-                    if 'x' in the_value:
-                        the_value = int(the_value, 16)
-                    else:
-                        the_value = int(the_value, 10)
-                # Describe what we are expecting on the bus.
-                set_expectation = "Error: first command must be one of the following {}, {}, {}, {}, {}, {}, {}, {}, {}, {}. ".format(FINDBOARD, GETDIRBIT, GETDIRREGISTER, SETDIRBIT, CLEARDIRBIT, GETIOPIN, GETIOREGISTER, SETDATAPIN, CLEARDATAPIN, TOGGLEPIN)
-                # Using a try here, because the command could also be very, very dirty.
-                try:
-                    if the_command not in {FINDBOARD, GETIOPIN, SETDIRBIT, CLEARDIRBIT, GETDIRBIT, SETDATAPIN, CLEARDATAPIN, GETIOREGISTER, GETDIRREGISTER, TOGGLEPIN}:
-                        self._return_error += set_expectation
-                        self._log.info(2, set_expectation)
-                except:
-                    # Exception can happen if the_command is something _very_ weird, so need to capture that too without crashing
-                    self._return_error += set_expectation
-                    self._log.info(2, set_expectation)
+                if the_command not in VALID_COMMANDS:
+                    return_errors.append(COMMAND_EXPECTATION)
+                    self._log.info(2, COMMAND_EXPECTATION)
                 
                 # Test if Board ID is a hex number within allowed Board IDs
-                try:
-                    if not(the_board in range(MINBOARDID, MAXBOARDID)):
-                        self._return_error += "Error: Board ID not in range [0x{:0{}X}, 0x{:0{}X}]. ".format(MINBOARDID, 2, MAXBOARDID-1, 2)
-                        self._log.info(2, "Error: Board ID not in range [0x{:0{}X}, 0x{:0{}X}]. ".format(MINBOARDID, 2, MAXBOARDID-1, 2))
-                except:
-                    # print error message to the systemctl log file
-                    if LOG_LEVEL == 2:
-                        print(traceback.format_exc())
-                    self._return_error += "Error: wrongly formatted register. "
-                    self._log.info(2, "Error: wrongly formatted register. ")
-
+                if not(MINBOARDID <= the_board <= MAXBOARDID):
+                    return_errors.append(BOARD_RANGE_ERROR)
+                    self._log.info(2, BOARD_RANGE_ERROR)
+
+                # Test if the pin mask is a hex number from 0x0000 to 0xffff (included)
+                if the_command in MASK_COMMANDS:
+                    if not(0 <= the_value < MAXMASK):
+                        return_errors.append(MASK_RANGE_ERROR)
+                        self._log.info(2, MASK_RANGE_ERROR)
                 # Test if the pin number is a hex number from 0x00 to 0x0f (included)
-                try:
-                    if not(the_value in range(MINPIN, MAXPIN)):
-                        self._return_error += "Error: registervalue not in range [0x{:0{}X}, 0x{:0{}X}]. ".format(MINPIN, 2, MAXPIN, 2)
-                        self._log.info(2, "Error: registervalue not in range [0x{:0{}X}, 0x{:0{}X}]. ".format(MINPIN, 2, MAXPIN, 2))
-                except:
-                    # print error message to the systemctl log file
-                    if LOG_LEVEL == 2:
-                        print(traceback.format_exc())
-                    self._return_error += "Error: wrongly formatted data byte. "
-                    self._log.info(2, "Error: wrongly formatted data byte. ")
+                elif not(MINPIN <= the_value < MAXPIN):
+                    return_errors.append(PIN_RANGE_ERROR)
+                    self._log.info(2, PIN_RANGE_ERROR)
                 
                 # All checks done, continue processing if no errors were found.
-                if self._return_error == '':
+                if not return_errors:
                     # print status message to the systemctl log file
                     if LOG_LEVEL == 2:
                         print("Processing: {}, {}, {}.".format(the_command, the_board, the_value))
@@ -362,13 +564,22 @@ class mcp23017broker():
                     return_data = self.ProcessCommand(the_command, the_board, the_value)
                     # Send an "OK" back, since we didn't find an error.
                     self._datapipe.ReturnResponse(command_id, return_data, 'OK')
-                    self._log.debug(2, "Action result: {} OK\n".format(return_data))
+                    self._log.debug(2, "Action result: %s OK\n", return_data)
                 else:
+                    return_error = "".join(return_errors)
                     # print error message to the systemctl log file
                     if LOG_LEVEL > 0:
-                        print(self._return_error)
+                        print(return_error)
                     # Send back an error if the command was not properly formatted. Do nothing else
-                    self._datapipe.ReturnResponse(command_id, '0x00', self._return_error)
+                    self._datapipe.ReturnResponse(command_id, '0x00', return_error)
+        # Let the caller know if there was a command, so it can back off when there is nothing to do.
+        return bool(command_list[0])
+
+    def WaitForCommands(self, timeout):
+        """
+        Waits at most timeout seconds for new commands. Returns True if a client signalled new commands.
+        """
+        return self._datapipe.WaitForCommands(timeout)
 
     def ProcessCommand(self, task, board_id, pin):
         """
@@ -377,203 +588,524 @@ class mcp23017broker():
         # Process I2C bus commands based on board ID and Pin nr
         return_byte = ""
         try:
-            if task == GETDIRBIT:
-                self._i2chandler.WaitForPinToBeReleased(board_id, pin, False)
-                return_byte = '0x{:0{}X}'.format(self._i2chandler.GetI2CDirPin(board_id, pin),2)
-                self._log.info(2, "Received byte [{}] from pin [{}] on board [{}] through GetI2CDirPin".format(return_byte, pin, board_id))
-            elif task == FINDBOARD:
-                self._i2chandler.WaitForPinToBeReleased(board_id, pin, False)
-                return_byte = '0x{:0{}X}'.format(self._i2chandler.IdentifyBoard(board_id),2)
-                self._log.info(2, "Received byte [{}] from board [{}] through IdentifyBoard".format(return_byte, board_id))
-            elif task == GETDIRREGISTER:
-                self._i2chandler.WaitForPinToBeReleased(board_id, pin, False)
-                return_byte = '0x{:0{}X}'.format(self._i2chandler.GetI2CDirRegister(board_id, pin),2)
-                self._log.info(2, "Received byte [{}] from pin [{}] on board [{}] through GetI2CDirRegister".format(return_byte, pin, board_id))
-            elif task == SETDIRBIT:
-                return_byte = ""
-                self._i2chandler.SetI2CDirPin(board_id, pin)
-                self._log.info(2, "Setting DIR bit [{}] on board [{}] through SetI2CDirPin".format(pin, board_id))
-                if self._xmldata is not None:
-                    self._i2chandler.WaitForPinToBeReleased(board_id, pin, False)
-                    self._xmldata.set_board_pin(board_id, pin)
-            elif task == CLEARDIRBIT:
-                return_byte = ""
-                self._i2chandler.ClearI2CDirPin(board_id, pin)
-                self._log.info(2, "Clearing DIR bit [{}] on board [{}] through ClearI2CDirPin".format(pin, board_id))
-                if self._xmldata is not None:
-                    self._i2chandler.WaitForPinToBeReleased(board_id, pin, False)
-                    self._xmldata.clear_board_pin(board_id, pin)
-            elif task == GETIOPIN:
-                self._i2chandler.WaitForPinToBeReleased(board_id, pin, False)
-                return_byte = '0x{:0{}X}'.format(self._i2chandler.GetI2CPin(board_id, pin),2)
-                self._log.info(2, "Received byte [{}] from pin [{}] on board [{}] through GetI2CPin".format(return_byte, pin, board_id))
-            elif task == GETIOREGISTER:
-                self._i2chandler.WaitForPinToBeReleased(board_id, pin, False)
-                return_byte = '0x{:0{}X}'.format(self._i2chandler.GetI2CIORegister(board_id, pin),2)
-                self._log.info(2, "Received Register [{}] from pin [{}] on board [{}] through GetI2CIORegister".format(return_byte, pin, board_id))
-            elif task == SETDATAPIN:
-                return_byte = ""
-                self._i2chandler.WaitForPinToBeReleased(board_id, pin, False)
-                self._i2chandler.SetI2CPin(board_id, pin)
-                self._log.info(2, "Setting bit [{}] on board [{}] through SetI2CPin".format(pin, board_id))
-            elif task == CLEARDATAPIN:
-                return_byte = ""
-                self._i2chandler.WaitForPinToBeReleased(board_id, pin, False)
-                self._i2chandler.ClearI2CPin(board_id, pin)
-                self._log.info(2, "Clearing bit [{}] on board [{}] through ClearI2CPin".format(pin, board_id))
-            elif task == TOGGLEPIN:
-                return_byte = ""
-                self._i2chandler.ToggleI2CPin(board_id, pin)
-                self._log.info(2, "Toggling bit [{}] on board [{}] through ToggleI2CPin".format(pin, board_id))
+            handler = self._dispatch.get(task)
+            if handler is not None:
+                return_byte = handler(board_id, pin)
             else:
                 # print error message to the systemctl log file
                 if LOG_LEVEL > 1:
                     print("Error: Did not understand command [{}].".format(task))
-                self._log.error(2, "Error: Did not understand command [{}].".format(task))
+                self._log.error(2, "Error: Did not understand command [%s].", task)
 
         except Exception as err:
-            error_string = traceback.format_exc()
-            # print error message to the systemctl log file
-            if LOG_LEVEL == 1:
-                print(error_string)
+            # Building the full traceback is expensive, so it is only done if it is printed or logged.
+            if LOG_LEVEL > 0:
+                error_string = traceback.format_exc()
+                # print error message to the systemctl log file
+                if LOG_LEVEL == 1:
+                    print(error_string)
+                self._log.error(1, "Error when processing I2C command: %s.", error_string)
             if self._xmldata is not None:
                 self._xmldata.DeleteKey(board_id)
-            self._log.error(1, "Error when processing I2C command: {}.".format(error_string))
         return return_byte
 
+    # The handlers that use the I2C handler more than once, bind it locally first.
+    def _DoGetDirBit(self, board_id, pin):
+        """
+        GETDIRBIT: returns the DIR bit of a pin (1 = input).
+        """
+        i2chandler = self._i2chandler
+        i2chandler.WaitForPinToBeReleased(board_id, pin, False)
+        return_byte = HEX_BYTE(i2chandler.GetI2CDirPin(board_id, pin))
+        self._log.info(2, "Received byte [%s] from pin [%s] on board [%s] through GetI2CDirPin", return_byte, pin, board_id)
+        return return_byte
+
+    def _DoFindBoard(self, board_id, pin):
+        """
+        FINDBOARD: returns 1 if the board is found on the I2C bus.
+        """
+        i2chandler = self._i2chandler
+        i2chandler.WaitForPinToBeReleased(board_id, pin, False)
+        return_byte = HEX_BYTE(i2chandler.IdentifyBoard(board_id))
+        self._log.info(2, "Received byte [%s] from board [%s] through IdentifyBoard", return_byte, board_id)
+        return return_byte
+
+    def _DoGetDirRegister(self, board_id, pin):
+        """
+        GETDIRREGISTER: returns the full DIR register.
+        """
+        i2chandler = self._i2chandler
+        i2chandler.WaitForPinToBeReleased(board_id, pin, False)
+        return_byte = HEX_BYTE(i2chandler.GetI2CDirRegister(board_id, pin))
+        self._log.info(2, "Received byte [%s] from pin [%s] on board [%s] through GetI2CDirRegister", return_byte, pin, board_id)
+        return return_byte
+
+    def _DoSetDirBit(self, board_id, pin):
+        """
+        SETDIRBIT: sets a pin to INPUT, and remembers this in the XML file.
+        """
+        i2chandler = self._i2chandler
+        i2chandler.SetI2CDirPin(board_id, pin)
+        self._log.info(2, "Setting DIR bit [%s] on board [%s] through SetI2CDirPin", pin, board_id)
+        if self._xmldata is not None:
+            i2chandler.WaitForPinToBeReleased(board_id, pin, False)
+            if not self._xmldata.set_board_pin(board_id, pin):
+                self._log.info(2, "Could not store DIR bit [%s] of board [%s] in the XML file", pin, board_id)
+        return ""
+
+    def _DoClearDirBit(self, board_id, pin):
+        """
+        CLEARDIRBIT: sets a pin to OUTPUT, and remembers this in the XML file.
+        """
+        i2chandler = self._i2chandler
+        i2chandler.ClearI2CDirPin(board_id, pin)
+        self._log.info(2, "Clearing DIR bit [%s] on board [%s] through ClearI2CDirPin", pin, board_id)
+        if self._xmldata is not None:
+            i2chandler.WaitForPinToBeReleased(board_id, pin, False)
+            if not self._xmldata.clear_board_pin(board_id, pin):
+                self._log.info(2, "Could not store DIR bit [%s] of board [%s] in the XML file", pin, board_id)
+        return ""
+
+    def _DoGetIOPin(self, board_id, pin):
+        """
+        GETIOPIN: returns the value of a pin.
+        """
+        i2chandler = self._i2chandler
+        i2chandler.WaitForPinToBeReleased(board_id, pin, False)
+        return_byte = HEX_BYTE(i2chandler.GetI2CPin(board_id, pin))
+        self._log.info(2, "Received byte [%s] from pin [%s] on board [%s] through GetI2CPin", return_byte, pin, board_id)
+        return return_byte
+
+    def _DoGetIORegister(self, board_id, pin):
+        """
+        GETIOREGISTER: returns the full IO register.
+        """
+        i2chandler = self._i2chandler
+        i2chandler.WaitForPinToBeReleased(board_id, pin, False)
+        return_byte = HEX_BYTE(i2chandler.GetI2CIORegister(board_id, pin))
+        self._log.info(2, "Received Register [%s] from pin [%s] on board [%s] through GetI2CIORegister", return_byte, pin, board_id)
+        return return_byte
+
+    def _DoSetDataPin(self, board_id, pin):
+        """
+        SETDATAPIN: sets a pin High.
+        """
+        i2chandler = self._i2chandler
+        i2chandler.WaitForPinToBeReleased(board_id, pin, False)
+        i2chandler.SetI2CPin(board_id, pin)
+        self._log.info(2, "Setting bit [%s] on board [%s] through SetI2CPin", pin, board_id)
+        return ""
+
+    def _DoClearDataPin(self, board_id, pin):
+        """
+        CLEARDATAPIN: sets a pin Low.
+        """
+        i2chandler = self._i2chandler
+        i2chandler.WaitForPinToBeReleased(board_id, pin, False)
+        i2chandler.ClearI2CPin(board_id, pin)
+        self._log.info(2, "Clearing bit [%s] on board [%s] through ClearI2CPin", pin, board_id)
+        return ""
+
+    def _DoSetDataPins(self, board_id, mask):
+        """
+        SETDATAPINS: sets all pins in a 16-bit mask High, with one write of both output latches.
+        """
+        i2chandler = self._i2chandler
+        for pin in range(MINPIN, MAXPIN):
+            if mask & (1 << pin):
+                i2chandler.WaitForPinToBeReleased(board_id, pin, False)
+        i2chandler.SetI2CPins(board_id, set_mask = mask)
+        self._log.info(2, "Setting bits [0x%04X] on board [%s] through SetI2CPins", mask, board_id)
+        return ""
+
+    def _DoClearDataPins(self, board_id, mask):
+        """
+        CLEARDATAPINS: sets all pins in a 16-bit mask Low, with one write of both output latches.
+        """
+        i2chandler = self._i2chandler
+        for pin in range(MINPIN, MAXPIN):
+            if mask & (1 << pin):
+                i2chandler.WaitForPinToBeReleased(board_id, pin, False)
+        i2chandler.SetI2CPins(board_id, clear_mask = mask)
+        self._log.info(2, "Clearing bits [0x%04X] on board [%s] through SetI2CPins", mask, board_id)
+        return ""
+
+    def _DoTogglePin(self, board_id, pin):
+        """
+        TOGGLEPIN: toggles a pin for TOGGLEDELAY seconds, in a separate thread.
+        """
+        self._i2chandler.ToggleI2CPin(board_id, pin)
+        self._log.info(2, "Toggling bit [%s] on board [%s] through ToggleI2CPin", pin, board_id)
+        return ""
+
+class TimedLock():
+    """
+    A Mutual Exclusive lock that doesn't block forever. The locks are only held for a few short I2C transfers, so a
+    waiting thread first tries a few more times, and gives the other threads (e.g. the one holding the lock) a chance
+    to run in between. Only then it goes to sleep until the lock is free. If the lock can not be acquired within the
+    time-out, a TimeoutError is raised, instead of having all threads waiting on one that hangs.
+    Can be used with 'with', or with acquire() and release().
+    """
+    def __init__(self, timeout = WATCHDOG_TIMEOUT, spin = 32):
+        self._lock = Lock()
+        self._timeout = timeout
+        self._spin = spin
+
+    def acquire(self):
+        # The first try is for free, this is by far the most common case.
+        lock = self._lock
+        if lock.acquire(blocking = False):
+            return True
+        # Try again a few times, and yield to the other threads in between. 
+        for _ in range(self._spin):
+            time.sleep(0)
+            if lock.acquire(blocking = False):
+                return True
+        # Still not free, wait for it.
+        if not lock.acquire(timeout = self._timeout):
+            raise TimeoutError("Could not acquire the I2C bus within [{}] seconds.".format(self._timeout))
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.release()
+
+class SimulatedSMBus():
+    """
+    Stand-in for the SMBus in DEMO_MODE_ONLY. Prints on screen what would happen on the I2C bus, and keeps the
+    written values in a register map, so that reads give back what was written before.
+    """
+    def __init__(self):
+        self._registers = {}
+
+    def read_byte_data(self, board_id, register):
+        if register in (GPIOA, GPIOB):
+            # The output pins read back what is in the output latch, the (simulated) input pins are all low.
+            latch = self._registers.get((board_id, OLATA if (register == GPIOA) else OLATB), 0x00)
+            value = latch & ~self._registers.get((board_id, IODIRA if (register == GPIOA) else IODIRB), 0xff) & 0xff
+        else:
+            # After power-on, all pins of an MCP23017 are inputs, i.e. the DIR registers are all ones.
+            value = self._registers.get((board_id, register), 0xff if register in (IODIRA, IODIRB) else 0x00)
+        print("SIMULATION : reading [0x%02X] from register [0x%02X] of board [0x%02X]" % (value, register, board_id))
+        return value
+
+    def write_byte_data(self, board_id, register, value):
+        print("SIMULATION : writing [0x%02X] to register [0x%02X] of board [0x%02X]" % (value, register, board_id))
+        self._registers[(board_id, register)] = value
+        # Writing a GPIO register ends up in the output latch
+        if register in (GPIOA, GPIOB):
+            self._registers[(board_id, OLATA if (register == GPIOA) else OLATB)] = value
+
+    def write_i2c_block_data(self, board_id, register, data):
+        # The MCP23017 increments the register address after every byte.
+        for offset, value in enumerate(data):
+            self.write_byte_data(board_id, register + offset, value)
+
 class i2cCommunication():
     """
     A class for doing communications to MCP23017 devices on the Raspberry Pi I2C bus.
+    Board IDs, pin numbers and register values are given as int.
     """
+    # There is only one I2C bus, so all instances (and all threads) share the same SMBus and the same bus Mutex.
+    # They are created the first time they are needed.
+    _shared_bus = None
+    _shared_bus_mutex = None
+    _shared_bus_lock = Lock()
+
+    @classmethod
+    def SharedBus(cls):
+        """
+        Returns the SMBus and its Mutex, shared by all instances. The bus is only opened once per process.
+        """
+        with cls._shared_bus_lock:
+            if cls._shared_bus is None:
+                # Create a new I2C bus (port 1 of the Raspberry Pi). In demo mode the bus is simulated.
+                if DEMO_MODE_ONLY:
+                    cls._shared_bus = SimulatedSMBus()
+                else:
+                    # smbus2 is only imported when the real bus is used, so demo mode also runs without it.
+                    from smbus2 import SMBus
+                    cls._shared_bus = SMBus(1)
+                # Set up a Mutual Exclusive lock, such that parallel threads are not interfering with another thread writing on the I2C bus
+                # The lock gives up after WATCHDOG_TIMEOUT seconds, so that a hanging thread can not block the whole server.
+                # This lock is only held for the I2C transfers themselves.
+                cls._shared_bus_mutex = TimedLock(WATCHDOG_TIMEOUT)
+            return cls._shared_bus, cls._shared_bus_mutex
+
     def __init__(self, the_log):
         # Copy logfile to local
         self._log = the_log
         self._log.info(2, "Initializing I2C Communication class.")
-        # Create an empty set to be used for avoiding that multiple toggle commands can operate on the same pin
-        # A mutex is needed to manage the self._toggle_set in a unique way
-        self._toggle_set = set()
-        self._toggle_mutex = Lock()
-        # Create a new I2C bus (port 1 of the Raspberry Pi)
-        if DEMO_MODE_ONLY:
-            self.i2cbus = 0
+        # Create an empty dict to be used for avoiding that multiple toggle commands can operate on the same pin.
+        # The keys are the board/pin pairs that are being toggled. dict.setdefault checks and claims a pin in a single
+        # step, which is atomic in Python, so no mutex is needed to manage the self._toggle_pins in a unique way.
+        # The value is an Event that is set when the toggle is done, so other threads can wait for the pin without polling.
+        self._toggle_pins = {}
+        # Toggles are handed over to a pool of at most TOGGLE_WORKERS threads, instead of starting a new thread for
+        # every toggle. If more toggles come in than there are workers, they wait in the queue of the pool.
+        # At exit, the pool first finishes the toggles that are still going on or waiting, so that no pin is left in 
+        # its toggled state.
+        self._toggle_pool = ThreadPoolExecutor(max_workers = TOGGLE_WORKERS, thread_name_prefix = "toggle")
+        # Get the I2C bus (port 1 of the Raspberry Pi) and its Mutex. The choice between the real and the simulated bus is
+        # made once, and the bus functions are bound locally, so the I2C functions don't have to check the mode at every access.
+        self.i2cbus, self._i2cMutex = self.SharedBus()
+        self._log.info(2, "Initialized SMBus 1 (I2C) and I2C Mutex.")
+        self._read_byte_data = self.i2cbus.read_byte_data
+        self._write_byte_data = self.i2cbus.write_byte_data
+        self._write_block_data = self.i2cbus.write_i2c_block_data
+        # Writing a register and reading it back can be done in one combined I2C transaction (one START and one STOP), 
+        # if the bus supports it. The simulated bus doesn't, and then the write and the read are done one after the other.
+        if hasattr(self.i2cbus, "i2c_rdwr"):
+            from smbus2 import i2c_msg
+            # The messages (and their buffers) are made once, and filled in at every transaction. This is safe since the
+            # transactions are only done while holding the I2C Mutex.
+            self._write_read_msgs = (i2c_msg.write(0x00, [0x00, 0x00]), i2c_msg.write(0x00, [0x00]), i2c_msg.read(0x00, 1))
+            self._write_read_byte_data = self._CombinedWriteRead
         else:
-            self.i2cbus = SMBus(1)
-            self._log.info(2, "Initializing SMBus 1 (I2C).")
-        # Set up a Mutual Exclusive lock, such that parallel threads are not interfering with another thread writing on the I2C bus
-        self._i2cMutex = Lock()
-        self._log.info(2, "Initialized I2C Mutex.")
-        # Initialize the boards that are being handled.
-        self.managedboards = []
+            self._write_read_byte_data = self._SeparateWriteRead
+        # Every board has its own lock for the read-modify-write of its shadow registers, so that a slow action on one
+        # board doesn't hold up the other boards. When both are needed, the board lock is always taken first.
+        self._board_locks = {}
+        # Initialize the boards that are being handled. A set is used, since this is checked for every command.
+        self.managedboards = set()
+        # Shadow copies of the registers, with (board_id, register) as key. The DIR registers and output latches
+        # only change when this program writes them, so they don't have to be read back from the I2C bus.
+        self._shadow = {}
+        # Register changes that are waiting to be written, with (board_id, register) as key. Each entry is a batch
+        # {'changes': [...], 'value': None}, in which the written value is filled in. See ModifyShadowRegister.
+        self._pending_changes = {}
+        self._pending_lock = Lock()
+        # The (monotonic) time at which each board last answered on the I2C bus. See IdentifyBoard.
+        self._probe_times = {}
 
     @property
     def allmanagedboards(self):
-        return self.managedboards
+        return sorted(self.managedboards)
+
+    def BoardLock(self, board_id):
+        """
+        Returns the lock of a board, the lock is created the first time.
+        """
+        try:
+            return self._board_locks[board_id]
+        except KeyError:
+            # setdefault makes sure that two threads asking at the same moment get the same lock.
+            return self._board_locks.setdefault(board_id, TimedLock(WATCHDOG_TIMEOUT))
+
+    def ReadShadowRegister(self, board_id, register):
+        """
+        Returns the shadow copy of a register. The register is only read from the I2C bus the first time.
+        """
+        with self.BoardLock(board_id):
+            try:
+                return self._shadow[(board_id, register)]
+            except KeyError:
+                with self._i2cMutex:
+                    value = self._read_byte_data(board_id, register)
+                self._shadow[(board_id, register)] = value
+                return value
+
+    def ModifyShadowRegister(self, board_id, register, set_bits = 0x00, clear_bits = 0x00, flip_bits = 0x00):
+        """
+        Sets, clears and then flips bits in a register, using the shadow copy instead of reading the register first.
+        Only the write goes over the I2C bus. Returns the new register value.
+        """
+        key = (board_id, register)
+        # Changes are first put on the pending list of the register. Threads that change the same register at the 
+        # same moment have to wait for the board lock anyway. The thread that gets the lock writes all changes that
+        # are pending at that moment in one go, and the others find their change already done when they get the lock.
+        with self._pending_lock:
+            batch = self._pending_changes.get(key)
+            if batch is None:
+                batch = self._pending_changes[key] = {'changes': [], 'value': None}
+            batch['changes'].append((set_bits, clear_bits, flip_bits))
+        with self.BoardLock(board_id):
+            with self._pending_lock:
+                if self._pending_changes.get(key) is batch:
+                    del self._pending_changes[key]
+                    changes = batch['changes']
+                else:
+                    changes = None
+            if changes is None:
+                # Another thread already wrote this change. The value is only filled in if that write succeeded. The
+                # shadow copy can't tell, because it may have been read again from the board after a failed write.
+                if batch['value'] is None:
+                    raise OSError("Writing register [0x{:02X}] of board [0x{:02X}] failed.".format(register, board_id))
+                return batch['value']
+            # Forget the old value first. If the write fails, the register is read again the next time.
+            value = self._shadow.pop(key, None)
+            if value is None:
+                with self._i2cMutex:
+                    value = self._read_byte_data(board_id, register)
+            new_value = value
+            for set_bits, clear_bits, flip_bits in changes:
+                new_value = ((new_value | set_bits) & ~clear_bits ^ flip_bits) & 0xff
+            # If the changes don't change anything (e.g. setting a pin that is already high), there is nothing to write.
+            if new_value != value:
+                with self._i2cMutex:
+                    self._write_byte_data(board_id, register, new_value)
+            self._shadow[key] = new_value
+            batch['value'] = new_value
+            return new_value
+
+    def InvalidateShadow(self, board_id):
+        """
+        Forgets all shadow registers of a board, e.g. after an I2C error. The registers are read again at the next access.
+        """
+        with self.BoardLock(board_id):
+            # Other boards can add shadow registers in the mean time, so go over a copy of the keys.
+            for key in [key for key in list(self._shadow) if key[0] == board_id]:
+                del self._shadow[key]
 
     def CheckInitializeBoard(self, board_id):
         """
         Verifies if a board is already in the managed list.
-        If not, the Control Register for the board is initialized.
+        If not, the Control Register for the board is initialized, and the shadow copies of the DIR registers and
+        output latches are filled in, so that later pin changes only have to write to the board.
+        The callers check the managedboards set first, so that this function is only called for new boards.
         """
-        # if board_id is given as a hex string, convert to int
-        if(isinstance(board_id,str)):
-            board_id = int(board_id, 16)
+        # Boards that are already managed need nothing else
+        if board_id in self.managedboards:
+            return True
         return_value = True
 
         try:
-            # check if a board is already managed. This lookup will result in an error if not
-            dummy = (self.managedboards.index(board_id) >= 0)
-        except:
-            # Wait for the I2C bus to become free
-            self._log.info(2, "Writing data [0x02] to IOCON register for board [0x{:0{}X}]".format(board_id, 2))
-            self._i2cMutex.acquire()
-            try:
-                # Initialize configuration register of the new board
-                if DEMO_MODE_ONLY:
-                    print("SIMULATION : writing data [0x02] to IOCON register for board [0x{:0{}X}]".format(board_id, 2))
-                else:
-                    self.i2cbus.write_byte_data(board_id, IOCON, 0x02)
-                # Since existing yet, add board to managed list if initialization was successful
-                self.managedboards.append(board_id)
-            except:
-                # An error happened when accessing the new board, maybe non-existing on the bus
-                return_value = False
-            finally:
-                # Free Mutex to avoid a deadlock situation
-                self._i2cMutex.release()
+            with self.BoardLock(board_id):
+                # Another thread may have initialized the board while waiting for the lock
+                if board_id not in self.managedboards:
+                    self._log.info(2, "Writing data [0x02] to IOCON register for board [0x%02X]", board_id)
+                    # Initialize configuration register of the new board
+                    # The Mutex is only held for the I2C transfer itself, and is always freed when leaving the block.
+                    read_byte_data = self._read_byte_data
+                    shadow = self._shadow
+                    with self._i2cMutex:
+                        self._write_byte_data(board_id, IOCON, 0x02)
+                        for register in (IODIRA, IODIRB, OLATA, OLATB):
+                            shadow[(board_id, register)] = read_byte_data(board_id, register)
+                    # Since existing yet, add board to managed list if initialization was successful
+                    self.managedboards.add(board_id)
+                    self._probe_times[board_id] = time.monotonic()
+        except OSError as err:
+            # An error happened when accessing the new board, maybe non-existing on the bus
+            self._log.error(2, "I2C error on board [0x%02X]: %s", board_id, err)
+            return_value = False
         if not(return_value):
-            self._log.error(2, "Writing [0x02] to IOCON register for board [0x{:0{}X}] Failed !".format(board_id, 2))
+            self._log.error(2, "Writing [0x02] to IOCON register for board [0x%02X] Failed !", board_id)
         return return_value
 
     def ReadI2CDir(self, board_id, port_id):
         """
         Function for reading the full DIR Register value for a specific IO board.
         """
-        # Verify in inputs are given as hex. Convert to int if so
-        if(isinstance(board_id,str)):
-            board_id = int(board_id, 16)
-        if(isinstance(port_id,str)):
-            port_id = int(port_id, 16)
-
         # Verify if board used already, initialize if not
-        if self.CheckInitializeBoard(board_id):
+        if (board_id in self.managedboards) or self.CheckInitializeBoard(board_id):
             return_value = -1
 
             # Only start writing if the I2C bus is available
-            self._log.info(2, "Reading DIR port [0x{:0{}X}] on board [0x{:0{}X}]".format(port_id, 2, board_id, 2))
-            self._i2cMutex.acquire()
+            self._log.info(2, "Reading DIR port [0x%02X] on board [0x%02X]", port_id, board_id)
             try:
-                # Read the current value of the DIR register
-                if DEMO_MODE_ONLY:
-                    print("SIMULATION : reading DIR port [0x{:0{}X}] on board [0x{:0{}X}]".format(port_id, 2, board_id, 2))
-                    return_value = 0xff
-                else:
-                    return_value = self.i2cbus.read_byte_data(board_id, port_id)
-            except:
+                # The locks are always freed when leaving the block, also on errors.
+                with self.BoardLock(board_id):
+                    # Read the current value of the DIR register
+                    with self._i2cMutex:
+                        return_value = self._read_byte_data(board_id, port_id)
+                    # Refresh the shadow copy with what is really in the register
+                    self._shadow[(board_id, port_id)] = return_value
+            except OSError as err:
                 # An error happened when accessing the new board, maybe non-existing on the bus
+                self._log.error(2, "I2C error on board [0x%02X]: %s", board_id, err)
                 return_value = -1
-            finally:
-                # Free Mutex to avoid a deadlock situation
-                self._i2cMutex.release()
         else:
             return_value = -1
         return return_value
 
-    def WriteI2CDir(self, board_id, port_id, newvalue):
+    def _CombinedWriteRead(self, board_id, register, value):
         """
-        Function for writing the full DIR Register value for a specific IO board
+        Writes a register and reads it back in a single combined I2C transaction. Returns the value read back.
+        Must be called with the I2C Mutex held.
+        """
+        write_msg, register_msg, read_msg = self._write_read_msgs
+        write_msg.addr = register_msg.addr = read_msg.addr = board_id
+        write_msg.buf[0] = register_msg.buf[0] = bytes((register,))
+        write_msg.buf[1] = bytes((value,))
+        self.i2cbus.i2c_rdwr(write_msg, register_msg, read_msg)
+        return ord(read_msg.buf[0])
+
+    def _SeparateWriteRead(self, board_id, register, value):
+        """
+        Writes a register and reads it back, for busses that don't do combined transactions. Returns the value read back.
+        Must be called with the I2C Mutex held.
         """
-        # Verify in inputs are given as hex. Convert to int if so
-        if(isinstance(board_id,str)):
-            board_id = int(board_id, 16)
-        if(isinstance(port_id,str)):
-            port_id = int(port_id, 16)
-        if(isinstance(newvalue,str)):
-            newvalue = int(newvalue, 16)
+        self._write_byte_data(board_id, register, value)
+        return self._read_byte_data(board_id, register)
 
+    def WriteI2CDir(self, board_id, port_id, newvalue, verify = False):
+        """
+        Function for writing the full DIR Register value for a specific IO board
+        A failing write raises an error on the bus, so the register is only read back for verification if verify is set.
+        """
         # Verify if board used already, initialize if not
-        if self.CheckInitializeBoard(board_id):
+        if (board_id in self.managedboards) or self.CheckInitializeBoard(board_id):
             return_value = True
 
             # Only start writing if the I2C bus is available
-            self._log.info(2, "Writing DIR port [0x{:0{}X}] on board [0x{:0{}X}] to new value [0x{:0{}X}]".format(port_id, 2, board_id, 2, newvalue, 2))
-            self._i2cMutex.acquire()
+            self._log.info(2, "Writing DIR port [0x%02X] on board [0x%02X] to new value [0x%02X]", port_id, board_id, newvalue)
             try:
-                if DEMO_MODE_ONLY:
-                    print("SIMULATION : writing DIR port [0x{:0{}X}] on board [0x{:0{}X}] to new value [0x{:0{}X}]".format(port_id, 2, board_id, 2, newvalue, 2))
-                    return_value = True
-                else:
-                    # Write the new value of the DIR register
-                    self.i2cbus.write_byte_data(board_id, port_id, newvalue)
-                    # Verify if the value is indeed accepted
-                    verification = self.i2cbus.read_byte_data(board_id, port_id)
-                    if verification != newvalue:
-                        return_value = False
-            except:
+                # The locks are always freed when leaving the block, also on errors.
+                with self.BoardLock(board_id):
+                    # Nothing to do if the DIR register already has the new value. Only a verify goes to the board anyway.
+                    if (not verify) and (self._shadow.get((board_id, port_id)) == newvalue):
+                        return True
+                    # Write the new value of the DIR register. The shadow copy is only updated after a successful write.
+                    self._shadow.pop((board_id, port_id), None)
+                    with self._i2cMutex:
+                        if verify:
+                            # Write, and verify if the value is indeed accepted
+                            if self._write_read_byte_data(board_id, port_id, newvalue) != newvalue:
+                                return_value = False
+                        else:
+                            self._write_byte_data(board_id, port_id, newvalue)
+                    if return_value:
+                        self._shadow[(board_id, port_id)] = newvalue
+            except OSError as err:
                 # An error happened when accessing the new board, maybe non-existing on the bus
+                self._log.error(2, "I2C error on board [0x%02X]: %s", board_id, err)
+                return_value = False
+        else:
+            return_value = False
+        return return_value
+
+    def WriteI2CDirPair(self, board_id, dir_a, dir_b):
+        """
+        Writes the DIR registers of port A and port B of a board in a single I2C block transfer. IODIRA and IODIRB are
+        adjacent registers, and the board increments the register address after every byte.
+        """
+        # Verify if board used already, initialize if not
+        if (board_id in self.managedboards) or self.CheckInitializeBoard(board_id):
+            return_value = True
+            self._log.info(2, "Writing DIR ports on board [0x%02X] to new values [0x%02X] and [0x%02X]", board_id, dir_a, dir_b)
+            try:
+                with self.BoardLock(board_id):
+                    # Nothing to do if both DIR registers already have the new values.
+                    shadow = self._shadow
+                    if (shadow.get((board_id, IODIRA)) == dir_a) and (shadow.get((board_id, IODIRB)) == dir_b):
+                        return True
+                    # The shadow copies are only updated after a successful write.
+                    shadow.pop((board_id, IODIRA), None)
+                    shadow.pop((board_id, IODIRB), None)
+                    with self._i2cMutex:
+                        self._write_block_data(board_id, IODIRA, [dir_a, dir_b])
+                    shadow[(board_id, IODIRA)] = dir_a
+                    shadow[(board_id, IODIRB)] = dir_b
+            except OSError as err:
+                # An error happened when accessing the board, maybe non-existing on the bus
+                self._log.error(2, "I2C error on board [0x%02X]: %s", board_id, err)
                 return_value = False
-            finally:
-                # Free Mutex to avoid a deadlock situation
-                self._i2cMutex.release()
         else:
             return_value = False
         return return_value
@@ -582,35 +1114,30 @@ class i2cCommunication():
         """
         Identifies if board exists on the I2C bus.
         """
-        # Verify in inputs are given as hex. Convert to int if so
-        if(isinstance(board_id,str)):
-            board_id = int(board_id, 16)
-
         # Verify if board used already, initialize if not
-        if self.CheckInitializeBoard(board_id):
+        if (board_id in self.managedboards) or self.CheckInitializeBoard(board_id):
             return_value = 1
 
+            # A board that was initialized (or probed) just before, answered on the bus already. No need to ask again.
+            now = time.monotonic()
+            if (now - self._probe_times.get(board_id, -PROBE_VALIDITY)) < PROBE_VALIDITY:
+                return 1
+
             # Pin values up to 0x0f go to GPIOA, higher values go to GPIOB
-            pin_nr = 1  # pick random pin number to be read from the board. We are not going to use it anyway.
             port_id = IODIRA
 
             # Only start reading if the I2C bus is available
-            self._log.info(2, "Reading DIR pin from port [0x{:0{}X}] of board [0x{:0{}X}]".format(port_id, 2, board_id, 2))
-            #self.i2cMutex.acquire()
+            self._log.info(2, "Reading DIR pin from port [0x%02X] of board [0x%02X]", port_id, board_id)
             try:
-                if DEMO_MODE_ONLY:
-                    return_value = (1 << pin_nr)
-                    print("SIMULATION : reading DIR pin [0x{:0{}X}] from port [0x{:0{}X}] of board [0x{:0{}X}]".format(return_value, 2, port_id, 2, board_id, 2))
-                else:
-                    # Read the current state of the IO register, then set ('OR') the one pin
-                    _ = self.i2cbus.read_byte_data(board_id, port_id) & (1 << pin_nr)
-                    return_value = 1
-            except:
+                # Read the DIR register, only to see if the board answers. The value itself is not used.
+                with self._i2cMutex:
+                    self._read_byte_data(board_id, port_id)
+                self._probe_times[board_id] = now
+                return_value = 1
+            except OSError as err:
                 # An error happened when accessing the new board, maybe non-existing on the bus
+                self._log.error(2, "I2C error on board [0x%02X]: %s", board_id, err)
                 return_value = 0
-            #finally:
-            #    # Free Mutex to avoid a deadlock situation
-            #    self.i2cMutex.release()
         else:
             return_value = 0
         return return_value        
@@ -620,46 +1147,31 @@ class i2cCommunication():
         Gets the current value of the DIR value of an pin on a board
         Pin number must be between 0 and 15
         """
-        # Verify in inputs are given as hex. Convert to int if so
-        if(isinstance(board_id,str)):
-            board_id = int(board_id, 16)
-        if(isinstance(pin_nr,str)):
-            pin_nr = int(pin_nr, 16)
-
         # Verify if MCP23017 pin number between 0 and 15
         if (pin_nr < 0) or (pin_nr > 15):
             return_value = -1
         else:
             # Verify if board used already, initialize if not
-            if self.CheckInitializeBoard(board_id):
+            if (board_id in self.managedboards) or self.CheckInitializeBoard(board_id):
                 return_value = 1
 
-                # Pin values up to 0x0f go to GPIOA, higher values go to GPIOB
-                if (pin_nr > 7):
-                    port_id = IODIRB
-                    pin_nr = pin_nr % 8
-                else:
-                    port_id = IODIRA
+                # Look up the register and the bit of the pin
+                port_id, pin_mask = IODIR_PINS[pin_nr]
 
                 # Only start reading if the I2C bus is available
-                self._log.info(2, "Reading DIR pin from port [0x{:0{}X}] of board [0x{:0{}X}]".format(port_id, 2, board_id, 2))
-                self._i2cMutex.acquire()
+                self._log.info(2, "Reading DIR pin from port [0x%02X] of board [0x%02X]", port_id, board_id)
                 try:
-                    if DEMO_MODE_ONLY:
-                        return_value = (1 << pin_nr)
-                        print("SIMULATION : reading DIR pin [0x{:0{}X}] from port [0x{:0{}X}] of board [0x{:0{}X}]".format(return_value, 2, port_id, 2, board_id, 2))
+                    # Get the current state of the DIR register from the shadow copy, then check the one pin
+                    data_byte = self.ReadShadowRegister(board_id, port_id)
+                    if (data_byte & pin_mask) == 0x00:
+                        return_value = 0
                     else:
-                        # Read the current state of the IO register, then set ('OR') the one pin
-                        if (self.i2cbus.read_byte_data(board_id, port_id) & (1 << pin_nr)) == 0x00:
-                            return_value = 0
-                        else:
-                            return_value = 1
-                except:
+                        return_value = 1
+                except OSError as err:
                     # An error happened when accessing the new board, maybe non-existing on the bus
+                    self._log.error(2, "I2C error on board [0x%02X]: %s", board_id, err)
+                    self.InvalidateShadow(board_id)
                     return_value = -1
-                finally:
-                    # Free Mutex to avoid a deadlock situation
-                    self._i2cMutex.release()
             else:
                 return_value = -1
         return return_value
@@ -669,19 +1181,13 @@ class i2cCommunication():
         Gets the current value of the DIR value of a pin on a board
         Pin number must be between 0 and 15
         """
-        # Verify in inputs are given as hex. Convert to int if so
-        if(isinstance(board_id,str)):
-            board_id = int(board_id, 16)
-        if(isinstance(reg_nr,str)):
-            reg_nr = int(reg_nr, 16)
-
         # Verify if MCP23017 pin number between 0 and 15
         if (reg_nr < 0) or (reg_nr > 15):
             return_value = -1
             #aise Exception("Pin number must be between 0 and 15, but got [", pin_nr, "] for board ", board_id)
         else:
             # Verify if board used already, initialize if not
-            if self.CheckInitializeBoard(board_id):
+            if (board_id in self.managedboards) or self.CheckInitializeBoard(board_id):
                 return_value = 1
 
                 # Pin values up to 0x0f go to GPIOA, higher values go to GPIOB
@@ -691,21 +1197,15 @@ class i2cCommunication():
                     port_id = IODIRA
 
                 # Only start reading if the I2C bus is available
-                self._log.info(2, "Reading DIR register from port [0x{:0{}X}] of board [0x{:0{}X}]".format(port_id, 2, board_id, 2))
-                self._i2cMutex.acquire()
+                self._log.info(2, "Reading DIR register from port [0x%02X] of board [0x%02X]", port_id, board_id)
                 try:
-                    if DEMO_MODE_ONLY:
-                        return_value = 0xff
-                        print("SIMULATION : reading DIR register [0x{:0{}X}] from port [0x{:0{}X}] of board [0x{:0{}X}]".format(return_value, 2, port_id, 2, board_id, 2))
-                    else:
-                        # Read the current state of the IO register, then set ('OR') the one pin
-                        return_value = self.i2cbus.read_byte_data(board_id, port_id)
-                except:
+                    # Get the current state of the DIR register from the shadow copy.
+                    return_value = self.ReadShadowRegister(board_id, port_id)
+                except OSError as err:
                     # An error happened when accessing the new board, maybe non-existing on the bus
+                    self._log.error(2, "I2C error on board [0x%02X]: %s", board_id, err)
+                    self.InvalidateShadow(board_id)
                     return_value = -1
-                finally:
-                    # Free Mutex to avoid a deadlock situation
-                    self._i2cMutex.release()
             else:
                 return_value = -1
         return return_value
@@ -715,139 +1215,54 @@ class i2cCommunication():
         Sets a pin to INPUT on a board
         Pin number must be between 0 and 15
         """
-        # Verify in inputs are given as hex. Convert to int if so
-        if(isinstance(board_id,str)):
-            board_id = int(board_id, 16)
-        if(isinstance(pin_nr,str)):
-            pin_nr = int(pin_nr, 16)
-        # Verify if MCP23017 pin number between 0 and 15
-        if (pin_nr < 0) or (pin_nr > 15):
-            return_value = False
-        else:
-            # Verify if board used already, initialize if not
-            if self.CheckInitializeBoard(board_id):
-                return_value = True
-
-                # Pin values up to 0x0f go to IODIRA, higher values go to IODIRB
-                if (pin_nr > 7):
-                    port_id = IODIRB
-                    pin_nr = pin_nr % 8
-                else:
-                    port_id = IODIRA
-
-                # Only start writing if the I2C bus is available
-                self._log.info(2, "Setting pin [0x{:0{}X}] to INPUT port [0x{:0{}X}] for board [0x{:0{}X}]".format(pin_nr, 2, port_id, 2, board_id,2))
-                self._i2cMutex.acquire()
-                try:
-                    # Read the current state of the IODIR, then set ('OR') the one pin
-                    if DEMO_MODE_ONLY:
-                        data_byte = (1 << pin_nr)
-                        print("SIMULATION : setting pin [0x{:0{}X}] to INPUT port [0x{:0{}X}] for board [0x{:0{}X}]".format(data_byte, 2, port_id, 2, board_id,2))
-                    else:
-                        data_byte = self.i2cbus.read_byte_data(board_id, port_id) | (1 << pin_nr)
-                        self.i2cbus.write_byte_data(board_id, port_id, data_byte)
-                except:
-                    # An error happened when accessing the new board, maybe non-existing on the bus
-                    return_value = False
-                finally:
-                    # Free Mutex to avoid a deadlock situation
-                    self._i2cMutex.release()
-            else:
-                return_value = False
-        return return_value
+        # Take the current state of the IODIR from the shadow copy, then set ('OR') the one pin
+        return self.ChangeI2CPin(board_id, pin_nr, IODIR_PINS, "Setting pin [0x%02X] to INPUT on port [0x%02X] for board [0x%02X]", set_pin = True)
         
     def ClearI2CDirPin(self, board_id, pin_nr):
         """
         Sets a pin to OUTPUT on a board
         Pin number must be between 0 and 15
         """
-        # Verify in inputs are given as hex. Convert to int if so
-        if(isinstance(board_id,str)):
-            board_id = int(board_id, 16)
-        if(isinstance(pin_nr,str)):
-            pin_nr = int(pin_nr, 16)
-        # Verify if MCP23017 pin number between 0 and 15
-        if (pin_nr < 0) or (pin_nr > 15):
-            return_value = False
-        else:
-            # Verify if board used already, initialize if not
-            if self.CheckInitializeBoard(board_id):
-                return_value = True
-
-                # Pin values up to 0x0f go to IODIRA, higher values go to IODIRB
-                if (pin_nr > 7):
-                    port_id = IODIRB
-                    pin_nr = (pin_nr % 8)
-                else:
-                    port_id = IODIRA
-
-                # Only start writing if the I2C bus is available
-                self._log.info(2, "Setting pin [0x{:0{}X}] to OUTPUT on port [0x{:0{}X}] for board [0x{:0{}X}]".format(pin_nr, 2, port_id, 2, board_id,2))
-                self._i2cMutex.acquire()
-                try:
-                    if DEMO_MODE_ONLY:
-                        data_byte = (1 << pin_nr)
-                        print("SIMULATION : Setting pin [0x{:0{}X}] to OUTPUT on port [0x{:0{}X}] for board [0x{:0{}X}]".format(data_byte, 2, port_id, 2, board_id, 2))
-                    else:
-                        # Read the current state of the IODIR, then clear ('AND') the one pin
-                        data_byte = self.i2cbus.read_byte_data(board_id, port_id) &  ~(1 << pin_nr)
-                        self.i2cbus.write_byte_data(board_id, port_id, data_byte)
-                except:
-                    # An error happened when accessing the new board, maybe non-existing on the bus
-                    return_value = False
-                finally:
-                    # Free Mutex to avoid a deadlock situation
-                    self._i2cMutex.release()
-            else:
-                return_value = False
-        return return_value
+        # Take the current state of the IODIR from the shadow copy, then clear ('AND') the one pin
+        return self.ChangeI2CPin(board_id, pin_nr, IODIR_PINS, "Setting pin [0x%02X] to OUTPUT on port [0x%02X] for board [0x%02X]", clear_pin = True)
 
     def GetI2CPin(self, board_id, pin_nr):
         """
         Gets the current value of a pin on a board
         Pin number must be between 0 and 15
         """
-        # Verify in inputs are given as hex. Convert to int if so
-        if(isinstance(board_id,str)):
-            board_id = int(board_id, 16)
-        if(isinstance(pin_nr,str)):
-            pin_nr = int(pin_nr, 16)
-
         # Verify if MCP23017 pin number between 0 and 15
         if (pin_nr < 0) or (pin_nr > 15):
             return_value = -1
             #aise Exception("Pin number must be between 0 and 15, but got [", pin_nr, "] for board ", board_id)
         else:
             # Verify if board used already, initialize if not
-            if self.CheckInitializeBoard(board_id):
+            if (board_id in self.managedboards) or self.CheckInitializeBoard(board_id):
                 return_value = 1
 
-                # Pin values up to 0x0f go to GPIOA, higher values go to GPIOB
-                if (pin_nr > 7):
-                    port_id = GPIOB
-                    pin_nr = pin_nr % 8
-                else:
-                    port_id = GPIOA
+                # Look up the register and the bit of the pin
+                port_id, pin_mask = GPIO_PINS[pin_nr]
 
                 # Only start reading if the I2C bus is available
-                self._log.info(2, "Reading pin [0x{:0{}X}] from port [0x{:0{}X}] of board [0x{:0{}X}]".format(pin_nr, 2, port_id, 2, board_id, 2))
-                self._i2cMutex.acquire()
+                self._log.info(2, "Reading pin [0x%02X] from port [0x%02X] of board [0x%02X]", pin_nr, port_id, board_id)
                 try:
-                    if DEMO_MODE_ONLY:
-                        return_value = (1 << pin_nr)
-                        print("SIMULATION : reading pin [0x{:0{}X}] from port [0x{:0{}X}] of board [0x{:0{}X}]".format(return_value, 2, port_id, 2, board_id, 2))
+                    if self.ReadShadowRegister(board_id, IODIR_PINS[pin_nr][0]) & pin_mask:
+                        # Input pin: read the current state of the IO register, then check the one pin.
+                        # The Mutex is always freed when leaving the block, also on errors.
+                        with self._i2cMutex:
+                            data_byte = self._read_byte_data(board_id, port_id)
                     else:
-                        # Read the current state of the IO register, then set ('OR') the one pin
-                        if (self.i2cbus.read_byte_data(board_id, port_id) & (1 << pin_nr)) == 0x00:
-                            return_value = 0
-                        else:
-                            return_value = 1
-                except:
+                        # Output pin: the pin has the value of its output latch, so the shadow copy of the latch is used,
+                        # without going to the I2C bus.
+                        data_byte = self.ReadShadowRegister(board_id, OLAT_PINS[pin_nr][0])
+                    if (data_byte & pin_mask) == 0x00:
+                        return_value = 0
+                    else:
+                        return_value = 1
+                except OSError as err:
                     # An error happened when accessing the new board, maybe non-existing on the bus
+                    self._log.error(2, "I2C error on board [0x%02X]: %s", board_id, err)
                     return_value = -1
-                finally:
-                    # Free Mutex to avoid a deadlock situation
-                    self._i2cMutex.release()
             else:
                 return_value = -1
         return return_value
@@ -857,19 +1272,13 @@ class i2cCommunication():
         Gets the current value of a pin on a board
         Pin number must be between 0 and 15
         """
-        # Verify in inputs are given as hex. Convert to int if so
-        if(isinstance(board_id,str)):
-            board_id = int(board_id, 16)
-        if(isinstance(reg_nr,str)):
-            reg_nr = int(reg_nr, 16)
-
         # Verify if MCP23017 pin number between 0 and 15
         if (reg_nr < 0) or (reg_nr > 15):
             return_value = -1
             #aise Exception("Pin number must be between 0 and 15, but got [", pin_nr, "] for board ", board_id)
         else:
             # Verify if board used already, initialize if not
-            if self.CheckInitializeBoard(board_id):
+            if (board_id in self.managedboards) or self.CheckInitializeBoard(board_id):
                 return_value = 1
 
                 # Pin values up to 0x0f go to GPIOA, higher values go to GPIOB
@@ -879,21 +1288,15 @@ class i2cCommunication():
                     port_id = GPIOA
 
                 # Only start reading if the I2C bus is available
-                self._log.info(2, "Reading register [0x{:0{}X}], i.e. port [0x{:0{}X}] of board [0x{:0{}X}]".format(reg_nr, 2, port_id, 2, board_id, 2))
-                self._i2cMutex.acquire()
+                self._log.info(2, "Reading register [0x%02X], i.e. port [0x%02X] of board [0x%02X]", reg_nr, port_id, board_id)
                 try:
-                    if DEMO_MODE_ONLY:
-                        return_value = 0xff
-                        print("SIMULATION : reading register [0x{:0{}X}] from port [0x{:0{}X}] of board [0x{:0{}X}]".format(return_value, 2, port_id, 2, board_id, 2))
-                    else:
-                        # Read the current state of the IO register, then set ('OR') the one pin
-                        return_value = self.i2cbus.read_byte_data(board_id, port_id)
-                except:
+                    # Read the current state of the IO register. The Mutex is always freed when leaving the block, also on errors.
+                    with self._i2cMutex:
+                        return_value = self._read_byte_data(board_id, port_id)
+                except OSError as err:
                     # An error happened when accessing the new board, maybe non-existing on the bus
+                    self._log.error(2, "I2C error on board [0x%02X]: %s", board_id, err)
                     return_value = -1
-                finally:
-                    # Free Mutex to avoid a deadlock situation
-                    self._i2cMutex.release()
             else:
                 return_value = -1
         return return_value
@@ -903,96 +1306,102 @@ class i2cCommunication():
         Sets a pin to HIGH on a board
         Pin number must be between 0 and 15
         """
-        # Verify in inputs are given as hex. Convert to int if so
-        if(isinstance(board_id,str)):
-            board_id = int(board_id, 16)
-        if(isinstance(pin_nr,str)):
-            pin_nr = int(pin_nr, 16)
-
-        # Verify if MCP23017 pin number between 0 and 15
-        if (pin_nr < 0) or (pin_nr > 15):
-            return_value = False
-            #aise Exception("Pin number must be between 0 and 15, but got [", pin_nr, "] for board ", board_id)
-        else:
-            # Verify if board used already, initialize if not
-            if self.CheckInitializeBoard(board_id):
-                return_value = True
-
-                # Pin values up to 0x0f go to GPIOA, higher values go to GPIOB
-                if (pin_nr > 7):
-                    port_id = GPIOB
-                    pin_nr = pin_nr % 8
-                else:
-                    port_id = GPIOA
-
-                # Only start writing if the I2C bus is available
-                self._log.info(2, "Setting pin [0x{:0{}X}] to HIGH on port [0x{:0{}X}] for board [0x{:0{}X}]".format(pin_nr, 2, port_id, 2, board_id, 2))
-                self._i2cMutex.acquire()
-                try:
-                    if DEMO_MODE_ONLY:
-                        data_byte = (1 << pin_nr)
-                        print("SIMULATION : setting pin [0x{:0{}X}] to HIGH on port [0x{:0{}X}] for board [0x{:0{}X}]".format(data_byte, 2, port_id, 2, board_id, 2))
-                    else:
-                        # Read the current state of the IO register, then set ('OR') the one pin
-                        data_byte = self.i2cbus.read_byte_data(board_id, port_id) | (1 << pin_nr)
-                        self.i2cbus.write_byte_data(board_id, port_id, data_byte)
-                except:
-                    # An error happened when accessing the new board, maybe non-existing on the bus
-                    return_value = False
-                finally:
-                    # Free Mutex to avoid a deadlock situation
-                    self._i2cMutex.release()
-            else:
-                return_value = False
-        return return_value
+        # Take the current state of the output latch from the shadow copy, then set ('OR') the one pin. Reading
+        # the GPIO register instead would copy the levels of the input pins into the output latch.
+        return self.ChangeI2CPin(board_id, pin_nr, OLAT_PINS, "Setting pin [0x%02X] to HIGH on port [0x%02X] for board [0x%02X]", set_pin = True)
         
     def ClearI2CPin(self, board_id, pin_nr):
         """
         Sets a pin to LOW on a board
         Pin number must be between 0 and 15
         """
-        # Verify in inputs are given as hex. Convert to int if so
-        if(isinstance(board_id,str)):
-            board_id = int(board_id, 16)
-        if(isinstance(pin_nr,str)):
-            pin_nr = int(pin_nr, 16)
+        # Take the current state of the output latch from the shadow copy, then clear ('AND') the one pin.
+        return self.ChangeI2CPin(board_id, pin_nr, OLAT_PINS, "Setting pin [0x%02X] to LOW on port [0x%02X] for board [0x%02X]", clear_pin = True)
 
+    def ToggleI2CPinOnce(self, board_id, pin_nr):
+        """
+        Inverts a pin on a board: a high pin goes low, a low pin goes high. Unlike ToggleI2CPin, the pin is not 
+        switched back after a while. Only one write goes over the I2C bus.
+        Pin number must be between 0 and 15
+        """
+        # Take the current state of the output latch from the shadow copy, then flip ('XOR') the one pin.
+        return self.ChangeI2CPin(board_id, pin_nr, OLAT_PINS, "Inverting pin [0x%02X] on port [0x%02X] for board [0x%02X]", flip_pin = True)
+
+    def ChangeI2CPin(self, board_id, pin_nr, pin_table, log_message, set_pin = False, clear_pin = False, flip_pin = False):
+        """
+        Sets, clears or flips one pin in a register of a board. The register and the bit of the pin are looked up in 
+        pin_table (IODIR_PINS for the direction, OLAT_PINS for the output value). This is the common part of the 
+        SetI2CDirPin, ClearI2CDirPin, SetI2CPin, ClearI2CPin and ToggleI2CPinOnce functions.
+        Pin number must be between 0 and 15
+        """
         # Verify if MCP23017 pin number between 0 and 15
         if (pin_nr < 0) or (pin_nr > 15):
             return_value = False
         else:
             # Verify if board used already, initialize if not
-            if self.CheckInitializeBoard(board_id):
+            if (board_id in self.managedboards) or self.CheckInitializeBoard(board_id):
                 return_value = True
 
-                # Pin values up to 0x0f go to GPIOA, higher values go to GPIOB
-                if (pin_nr > 7):
-                    port_id = GPIOB
-                    pin_nr = (pin_nr % 8)
-                else:
-                    port_id = GPIOA
+                # Look up the register and the bit of the pin
+                port_id, pin_mask = pin_table[pin_nr]
 
                 # Only start writing if the I2C bus is available
-                self._log.info(2, "Setting pin [0x{:0{}X}] to LOW on port [0x{:0{}X}] for board [0x{:0{}X}]".format(pin_nr, 2, port_id, 2, board_id, 2))
-                self._i2cMutex.acquire()
+                self._log.info(2, log_message, pin_nr, port_id, board_id)
                 try:
-                    if DEMO_MODE_ONLY:
-                        data_byte = (1 << pin_nr)
-                        print("SIMULATION : setting pin [0x{:0{}X}] to LOW on port [0x{:0{}X}] for board [0x{:0{}X}]".format(data_byte, 2, port_id, 2, board_id, 2))
-                    else:
-                        # Read the current state of the IO register, then set ('OR') the one pin
-                        data_byte = self.i2cbus.read_byte_data(board_id, port_id) &  ~(1 << pin_nr)
-                        self.i2cbus.write_byte_data(board_id, port_id, data_byte)
-                except:
-                    # An error happened when accessing the new board, maybe non-existing on the bus
+                    self.ModifyShadowRegister(board_id, port_id, 
+                                              set_bits = pin_mask if set_pin else 0x00,
+                                              clear_bits = pin_mask if clear_pin else 0x00,
+                                              flip_bits = pin_mask if flip_pin else 0x00)
+                except OSError as err:
+                    # An error happened when accessing the board, maybe non-existing on the bus
+                    self._log.error(2, "I2C error on board [0x%02X]: %s", board_id, err)
+                    self.InvalidateShadow(board_id)
                     return_value = False
-                finally:
-                    # Free Mutex to avoid a deadlock situation
-                    self._i2cMutex.release()
             else:
                 return_value = False
         return return_value
 
+    def SetI2CPins(self, board_id, set_mask = 0x0000, clear_mask = 0x0000):
+        """
+        Sets and clears several pins of a board at once. Bits 0 to 7 of the masks are the pins of port A, bits 8 to 15 
+        the pins of port B. Pins that are both in the set_mask and the clear_mask are set.
+        Both output latches are written in a single I2C block transfer, instead of one transfer per pin.
+        """
+        # Verify if board used already, initialize if not
+        if (board_id in self.managedboards) or self.CheckInitializeBoard(board_id):
+            return_value = True
+            self._log.info(2, "Setting pins [0x%04X] and clearing pins [0x%04X] on board [0x%02X]", set_mask, clear_mask, board_id)
+            try:
+                with self.BoardLock(board_id):
+                    # Take the current state of the output latches from the shadow copies
+                    value_a = self._shadow.pop((board_id, OLATA), None)
+                    value_b = self._shadow.pop((board_id, OLATB), None)
+                    with self._i2cMutex:
+                        if value_a is None:
+                            value_a = self._read_byte_data(board_id, OLATA)
+                        if value_b is None:
+                            value_b = self._read_byte_data(board_id, OLATB)
+                        value_a = (value_a & ~clear_mask | set_mask) & 0xff
+                        value_b = (value_b & ~(clear_mask >> 8) | (set_mask >> 8)) & 0xff
+                        # OLATA and OLATB are adjacent registers, so both are written in one go.
+                        self._write_block_data(board_id, OLATA, [value_a, value_b])
+                    self._shadow[(board_id, OLATA)] = value_a
+                    self._shadow[(board_id, OLATB)] = value_b
+            except OSError as err:
+                # An error happened when accessing the board, maybe non-existing on the bus
+                self._log.error(2, "I2C error on board [0x%02X]: %s", board_id, err)
+                self.InvalidateShadow(board_id)
+                return_value = False
+        else:
+            return_value = False
+        return return_value
+
+    def WritePortPair(self, board_id, value_a, value_b):
+        """
+        Writes the output latches of port A and port B of a board in a single I2C block transfer.
+        """
+        return self.SetI2CPins(board_id, set_mask = ((value_b & 0xff) << 8) | (value_a & 0xff), clear_mask = 0xffff)
+
     def ToggleI2CPin(self, board_id, pin_nr, acquire_state = False):
         """
         Toggles a bit on the board. If the pin is high, it will be momentarily set to low. If it is low, it will toggle to high.
@@ -1001,105 +1410,141 @@ class i2cCommunication():
         switch. In some cases, the trigger is to the "other" side. acquire_state can be set to first assess the pin and briefly
         toggle the pin to the other high/low state.
         """
-        # Verify in inputs are given as hex. Convert to int if so
-        if(isinstance(board_id,str)):
-            board_id = int(board_id, 16)
-        if(isinstance(pin_nr,str)):
-            pin_nr = int(pin_nr, 16)
-
         # Verify if MCP23017 pin number between 0 and 15
         if (pin_nr < 0) or (pin_nr > 15):
             return_value = False
         else:
             return_value = True
             # Toggling can take a long time, during which the server would not be able to process additional commands.
-            # To avoid that the server is frozen, toggles are processed in separate threads.
-            a_thread = Thread(target = self.PinToggler, args = [board_id, pin_nr], daemon = False)
-            a_thread.start()
+            # To avoid that the server is frozen, toggles are processed by the worker threads.
+            self._toggle_pool.submit(self.ToggleTask, board_id, pin_nr, acquire_state)
         return return_value
+
+    def ToggleTask(self, board_id, pin_nr, acquire_state = False):
+        """
+        Processes one toggle in a thread of the toggle pool.
+        """
+        try:
+            self.PinToggler(board_id, pin_nr, acquire_state)
+        except Exception as err:
+            # The pool would keep the error in the (unused) Future, so log it here.
+            self._log.error(1, "Toggling pin [0x%02X] on board [0x%02X] failed. Error Message: %s", pin_nr, board_id, err)
     
     def WaitForPinToBeReleased(self, board_id, pin_nr, lock_if_free = False):
         """
         Toggling can take a long time, during which the server would not be able to process additional commands.
         To avoid that the server is frozen, toggles are processed in separate threads. The boards being 
-        processed are maintained in the _toggle_set. As long as a thread has a toggle action going on, no other
+        processed are maintained in the _toggle_pins. As long as a thread has a toggle action going on, no other
         actions are allowed on the specific board/pin combination. Therefore, all writes have to wait for the
         pin to be freed up again.
         """
-        # The verification can not last longer than a TOGGLEDELAY. Keep track of the time, and time-out if necessary
-        checking_time = datetime.now()
-        keep_checking = True
-        while keep_checking:
-            # The _toggle_set is protected with a mutex to avoid that two threads are manipulating at the same
-            # moment, thus resulting in data errors.
-            acquired = self._toggle_mutex.acquire(blocking = True, timeout = COMMAND_TIMEOUT)
-            if acquired:
-                if (board_id, pin_nr) not in self._toggle_set:
-                    if lock_if_free:
-                        self._toggle_set.add((board_id, pin_nr))
-                    keep_checking = False
-                self._toggle_mutex.release()
-            if (datetime.now() - checking_time).total_seconds()  > max (COMMAND_TIMEOUT, TOGGLEDELAY):
-                keep_checking = False
-                raise "Time-out error trying to acquire pin {} on board {}".format(board_id, pin_nr)
+        # The verification can not last longer than a TOGGLEDELAY. Keep track of the time, and time-out if necessary.
+        # The monotonic clock is cheap to read, and is not affected by clock adjustments.
+        toggle_pins = self._toggle_pins
+        toggle_key = (board_id, pin_nr)
+        # The Event of our own claim on the pin. Only made if the pin is to be claimed.
+        claim = Event() if lock_if_free else None
+        time_limit = max(COMMAND_TIMEOUT, TOGGLEDELAY)
+        checking_time = time.monotonic()
+        while True:
+            # setdefault only stores the claim if no other thread has the pin. Checking and claiming is a single 
+            # (atomic) step, so two threads can never claim the same pin at the same moment.
+            if lock_if_free:
+                holder = toggle_pins.setdefault(toggle_key, claim)
+                if holder is claim:
+                    break
+            else:
+                holder = toggle_pins.get(toggle_key)
+                if holder is None:
+                    break
+            # The pin is still being toggled. Sleep until the toggle thread signals that it is done, instead of 
+            # spinning on the CPU. This matters most on a single-core Pi.
+            time_left = time_limit - (time.monotonic() - checking_time)
+            if (time_left <= 0) or not holder.wait(time_left):
+                raise TimeoutError("Time-out error trying to acquire pin {} on board {}".format(pin_nr, board_id))
 
     def PinToggler(self, board_id, pin_nr, acquire_state = False):
         """
         The PinToggler is a separate process, run in a thread. This allows the main loop to continue processing other read/write requests.
         """
         # First make sure to do the bookkeeping.
-        if self.CheckInitializeBoard(board_id):
+        if (board_id in self.managedboards) or self.CheckInitializeBoard(board_id):
             Process_Toggle = False
 
             try:
                 self.WaitForPinToBeReleased(board_id, pin_nr, True)
                 Process_Toggle = True
             except Exception as err:
-                self._log.error(2, "Unable to toggle pin [0x{:0{}X}] on board [0x{:0{}X}]: Could not get pin free within [{}] seconds. Error Message: {}".format(pin_nr, 2, board_id, 2, COMMAND_TIMEOUT, err))
+                self._log.error(2, "Unable to toggle pin [0x%02X] on board [0x%02X]: Could not get pin free within [%s] seconds. Error Message: %s", pin_nr, board_id, COMMAND_TIMEOUT, err)
                 Process_Toggle = False
 
             if Process_Toggle:
-                self._log.info(2, "Toggling pin [0x{:0{}X}] on board [0x{:0{}X}]".format(pin_nr, 2, board_id, 2))
-                # Default is that pin is toggled from low to high briefly.
-                # If 'acquire_state' is set, the current state is assessed, and switched briefly to the "other" high/low state.
-                if acquire_state:
-                    current_state = self.GetI2CPin(board_id, pin_nr)
-                else:
-                    # Default is Low for current state and toggle to high to switch on e.g. a momentary switch.
-                    current_state = 0x0
-
-                if current_state == 0x0:
-                    # Current state is low (0x0), and toggling needs to go to high briefly
-                    self._log.info(2, "Toggling pin [0x{:0{}X}] on board [0x{:0{}X}] from LOW to HIGH".format(pin_nr, 2, board_id, 2))
-                    self.SetI2CPin(board_id, pin_nr)
-                    time.sleep(TOGGLEDELAY)
-                    self.ClearI2CPin(board_id, pin_nr)
-                    self._log.info(2, "Toggled pin [0x{:0{}X}] on board [0x{:0{}X}] back from HIGH to LOW".format(pin_nr, 2, board_id, 2))
-                if current_state == 0x1:
-                    # Current state is high (0x1 or more), and toggling needs to go to low briefly
-                    self._log.info(2, "Toggling pin [0x{:0{}X}] on board [0x{:0{}X}] from HIGH to LOW".format(pin_nr, 2, board_id, 2))
-                    self.ClearI2CPin(board_id, pin_nr)
-                    time.sleep(TOGGLEDELAY)
-                    self.SetI2CPin(board_id, pin_nr)
-                    self._log.info(2, "Toggled pin [0x{:0{}X}] on board [0x{:0{}X}] back from LOW to HIGH".format(pin_nr, 2, board_id, 2))
-                self._log.info(2, "Releasing (0x{:0{}X}, 0x{:0{}X}) from the Toggle set".format(board_id, 2, pin_nr, 2))
-                # Make sure to remove the board/pin pair from the _toggle_set at the end, or the pin will be blocked for all other processing
-                self._toggle_set.remove((board_id, pin_nr))
+                self._log.info(2, "Toggling pin [0x%02X] on board [0x%02X]", pin_nr, board_id)
+                # The board and pin were checked already, so the output latch is changed directly instead of going
+                # through SetI2CPin and ClearI2CPin, which would check everything again.
+                latch, pin_bit = OLAT_PINS[pin_nr]
+                try:
+                    # Default is that pin is toggled from low to high briefly.
+                    # If 'acquire_state' is set, the current state is assessed, and switched briefly to the "other" high/low state.
+                    if acquire_state:
+                        # The state of an output pin is in the shadow copy of the output latch, no need to read the I2C bus.
+                        current_state = 0x1 if (self.ReadShadowRegister(board_id, latch) & pin_bit) else 0x0
+                    else:
+                        # Default is Low for current state and toggle to high to switch on e.g. a momentary switch.
+                        current_state = 0x0
+                    if current_state == 0x0:
+                        # Current state is low (0x0), and toggling needs to go to high briefly
+                        self._log.info(2, "Toggling pin [0x%02X] on board [0x%02X] from LOW to HIGH", pin_nr, board_id)
+                        self.ModifyShadowRegister(board_id, latch, set_bits = pin_bit)
+                        time.sleep(TOGGLEDELAY)
+                        self.ModifyShadowRegister(board_id, latch, clear_bits = pin_bit)
+                        self._log.info(2, "Toggled pin [0x%02X] on board [0x%02X] back from HIGH to LOW", pin_nr, board_id)
+                    if current_state == 0x1:
+                        # Current state is high (0x1 or more), and toggling needs to go to low briefly
+                        self._log.info(2, "Toggling pin [0x%02X] on board [0x%02X] from HIGH to LOW", pin_nr, board_id)
+                        self.ModifyShadowRegister(board_id, latch, clear_bits = pin_bit)
+                        time.sleep(TOGGLEDELAY)
+                        self.ModifyShadowRegister(board_id, latch, set_bits = pin_bit)
+                        self._log.info(2, "Toggled pin [0x%02X] on board [0x%02X] back from LOW to HIGH", pin_nr, board_id)
+                except Exception as err:
+                    # An error happened when accessing the board, maybe removed from the bus
+                    self.InvalidateShadow(board_id)
+                    self._log.error(2, "Toggling pin [0x%02X] on board [0x%02X] failed. Error Message: %s", pin_nr, board_id, err)
+                finally:
+                    self._log.info(2, "Releasing (0x%02X, 0x%02X) from the Toggle set", board_id, pin_nr)
+                    # Make sure to remove the board/pin pair from the _toggle_pins at the end, or the pin will be blocked for all other processing
+                    # Then wake up the threads that are waiting for the pin.
+                    self._toggle_pins.pop((board_id, pin_nr)).set()
         else:
-            self._log.error(2, "Toggling pin failed for [0x{:0{}X}] on board [0x{:0{}X}]: could not initialize board.".format(pin_nr, 2, board_id, 2))
+            self._log.error(2, "Toggling pin failed for [0x%02X] on board [0x%02X]: could not initialize board.", pin_nr, board_id)
 
     def BusIDBlinker(self, board_id = 0x20, num_flashes = 10):
         """
         Test routine only, briefly switches pin 15 on the board on and off. It is used to find back a board in the rack.
         Please mind that this is a specific routine which expects pin 15 of the MCP23017 to be set as output to an identification LED.
+        Returns False if the board could not be reached.
         """
-        if(isinstance(board_id,str)):
-            board_id = int(board_id, 16)
-        for i in range(0, num_flashes):
-            self.ClearI2CPin(board_id,15)
-            time.sleep(0.5)
-            self.SetI2CPin(board_id,15)
-            time.sleep(0.5)
+        # Verify if board used already, initialize if not. This also fills in the shadow copy of the output latch.
+        if (board_id in self.managedboards) or self.CheckInitializeBoard(board_id):
+            return_value = True
+            # Pin 15 is bit 7 of the output latch of port B. The other pins keep the value in the shadow copy of the latch, 
+            # so every flash is a single byte written to OLATB, without reading the board.
+            latch, pin_bit = OLAT_PINS[15]
+            modify = self.ModifyShadowRegister
+            try:
+                for i in range(0, num_flashes):
+                    modify(board_id, latch, clear_bits = pin_bit)
+                    time.sleep(0.5)
+                    modify(board_id, latch, set_bits = pin_bit)
+                    time.sleep(0.5)
+            except OSError as err:
+                # An error happened when accessing the board, maybe non-existing on the bus
+                self._log.error(2, "I2C error on board [0x%02X]: %s", board_id, err)
+                self.InvalidateShadow(board_id)
+                return_value = False
+        else:
+            return_value = False
+        return return_value
 
 class xmlParameterHandler():
     """
@@ -1113,9 +1558,20 @@ class xmlParameterHandler():
     def __init__(self, the_log, xml_file_name = ''):
         # Copy logfile to local
         self._log = the_log
+        # Index on the XML data, so that boards and ports can be found without going over the whole tree.
+        # _boards has the board elements, and _ports the port elements per board, with the hex names as keys.
+        self._boards = {}
+        self._ports = {}
+        # The XML data is changed by the main loop, and written to file by a timer thread. The lock makes sure that
+        # a half-changed tree is never written. It is re-entrant, because e.g. CreateNewKey calls DeleteKey.
+        self._xml_lock = RLock()
+        self._dirty = False
+        self._flush_timer = None
+        # The board and port values as they are in the file. See ConfigState.
+        self._written_state = None
         # Only read config file if a name was provided
         if (CONFIGURATION_FILE == '') and (xml_file_name == ''):
-            self._confdata = ET.fromstring(b'<DATA>\n <i2cboards>\n </i2cboards>\n</DATA>')
+            self._confdata = ET.fromstring(EMPTY_XML_DATA, self.XMLParser())
             self._use_config_file = False
         else:
             self._use_config_file = True
@@ -1127,11 +1583,27 @@ class xmlParameterHandler():
                 self._filename = xml_file_name
             # Create initial empty datastring
             self.read_parameter_file()
+            # Make sure that the last changes are written when the program stops.
+            atexit.register(self.FlushParameterFile)
 
     @property
     def get_all_boards(self):
         return self._confdata[0]
 
+    def BuildIndex(self):
+        """
+        (Re)builds the index on the boards and ports in the XML data. If a board is in the file more than once, 
+        only the last one is kept.
+        """
+        self._boards = {}
+        self._ports = {}
+        for child in list(self._confdata[0]):
+            board_id = child.attrib.get("name")
+            if board_id in self._boards:
+                self._confdata[0].remove(self._boards[board_id])
+            self._boards[board_id] = child
+            self._ports[board_id] = {subchild.attrib.get("name"): subchild for subchild in child}
+
     def get_board_dir(self, board_id, port_id):
         """
         Get the Direction value of a specific board
@@ -1139,22 +1611,14 @@ class xmlParameterHandler():
         return_value = "0xff"
         if self._use_config_file:
             if(isinstance(board_id, int)):
-                board_id = '0x{:0{}X}'.format(board_id,2)
+                board_id = HEX_BYTE(board_id)
             if(isinstance(port_id, int)):
-                port_id = '0x{:0{}X}'.format(port_id,2)
-            have_found_lev1 = False
-            for child in self._confdata[0]:
-                have_found_lev2 = False
-                if child.attrib["name"] == board_id:
-                    have_found_lev1 = True
-                    for subchild in child:
-                        if subchild.attrib["name"] == port_id:
-                            return_value = subchild.text
-                            have_found_lev2 = True
-                    if (not(have_found_lev2)) or (len(child) != 2):
-                        self._confdata[0].remove(child)
-                        have_found_lev1 = False
-            if not(have_found_lev1):
+                port_id = HEX_BYTE(port_id)
+            ports = self._ports.get(board_id)
+            if (ports is not None) and (port_id in ports) and (len(self._boards[board_id]) == 2):
+                return_value = ports[port_id].text
+            else:
+                # The board is not in the file yet, or the entry is not complete. (Re)create it.
                 self.CreateNewKey(board_id)
         return return_value
 
@@ -1166,73 +1630,66 @@ class xmlParameterHandler():
         if self._use_config_file:
             # if byte or integer given, update to hex byte
             if(isinstance(board_id, int)):
-                board_id = '0x{:0{}X}'.format(board_id,2)
+                board_id = HEX_BYTE(board_id)
             if(isinstance(port_id, int)):
-                port_id = '0x{:0{}X}'.format(port_id,2)
+                port_id = HEX_BYTE(port_id)
             if(isinstance(newvalue, int)):
-                newvalue = '0x{:0{}X}'.format(newvalue,2)
+                newvalue = HEX_BYTE(newvalue)
             # Verify if value already exists (and create key if not in the file yet)
             comparevalue = self.get_board_dir(board_id, port_id)
-            # update board and port pair, and write back to paramete file
+            # update board and port pair. The parameter file is written a little later, together with other changes.
             if comparevalue != newvalue:
-                for child in self._confdata[0]:
-                    if child.attrib["name"] == board_id:
-                        for subchild in child:
-                            if subchild.attrib["name"] == port_id:
-                                subchild.text = newvalue
-                return_value = self.write_parameter_file()
+                with self._xml_lock:
+                    port = self._ports.get(board_id, {}).get(port_id)
+                    if port is not None:
+                        port.text = newvalue
+                self.MarkDirty()
         return return_value
 
     def set_board_pin(self, board_id, pin_nr):
         """
         Set the pin value of the Direction register for a specific board
         """
-        return_value = True
-        if self._use_config_file:
-            # Verify in inputs are given as hex. Convert to int if so
-            if(isinstance(board_id,str)):
-                board_id = int(board_id, 16)
-            if(isinstance(pin_nr,str)):
-                pin_nr = int(pin_nr, 16)
-            # Pin values up to 0x0f go to IODIRA, higher values go to IODIRB
-            if (pin_nr > 7):
-                port_id = IODIRB
-                pin_nr = pin_nr % 8
-            else:
-                port_id = IODIRA
-
-            currentvalue = self.get_board_dir(board_id, port_id)
-            if(isinstance(currentvalue,str)):
-                currentvalue = int(currentvalue, 16)
-
-            newvalue = currentvalue | (1 << pin_nr)
-            return_value = self.set_board_dir(board_id, port_id, newvalue)
-        return True
+        # Look up the register and the bit of the pin
+        port_id, pin_mask = IODIR_PINS[HEX_VALUE(pin_nr)]
+        return self.update_board_dir(board_id, port_id, set_mask = pin_mask)
 
     def clear_board_pin(self, board_id, pin_nr):
         """
         Clear the pin value of the Direction register for a specific board
         """
-        return_value = True
-        if self._use_config_file:
-            # Verify in inputs are given as hex. Convert to int if so
-            if(isinstance(board_id,str)):
-                board_id = int(board_id, 16)
-            if(isinstance(pin_nr,str)):
-                pin_nr = int(pin_nr, 16)
-            # Pin values up to 0x0f go to IODIRA, higher values go to IODIRB
-            if (pin_nr > 7):
-                port_id = IODIRB
-                pin_nr = pin_nr % 8
-            else:
-                port_id = IODIRA
-
-            currentvalue = self.get_board_dir(board_id, port_id)
-            if(isinstance(currentvalue,str)):
-                currentvalue = int(currentvalue, 16)
+        # Look up the register and the bit of the pin
+        port_id, pin_mask = IODIR_PINS[HEX_VALUE(pin_nr)]
+        return self.update_board_dir(board_id, port_id, clear_mask = pin_mask)
 
-            newvalue = currentvalue &  ~(1 << pin_nr)
-            return_value = self.set_board_dir(board_id, port_id, newvalue)
+    def update_board_dir(self, board_id, port_id, set_mask = 0x00, clear_mask = 0x00):
+        """
+        Sets and clears bits of the Direction value of a specific board in one go. The board and port are only looked
+        up once, and the parameter file is written a little later, together with other changes.
+        Returns False if the value could not be stored, e.g. because the parameter file is not used (any more).
+        """
+        return_value = False
+        if self._use_config_file:
+            # Board and port ids can be given as int or as hex. The XML data uses the (upper case) hex names.
+            board_id = HEX_BYTE(HEX_VALUE(board_id))
+            port_id = HEX_BYTE(HEX_VALUE(port_id))
+            changed = False
+            with self._xml_lock:
+                ports = self._ports.get(board_id)
+                if (ports is None) or (port_id not in ports) or (len(self._boards[board_id]) != 2):
+                    # The board is not in the file yet, or the entry is not complete. (Re)create it.
+                    self.CreateNewKey(board_id)
+                    ports = self._ports.get(board_id, {})
+                port = ports.get(port_id)
+                # (Re)creating the board can write the file. If that failed, the parameter file is no longer used.
+                if (port is not None) and self._use_config_file:
+                    newvalue = HEX_BYTE((HEX_VALUE(port.text) | set_mask) & ~clear_mask & 0xff)
+                    if port.text != newvalue:
+                        port.text = newvalue
+                        changed = True
+                    return_value = True
+            if changed:
+                self.MarkDirty()
         return return_value
 
     def DeleteKey(self, board_id):
@@ -1242,14 +1699,15 @@ class xmlParameterHandler():
         return_value = True
         if self._use_config_file:
             if(isinstance(board_id, int)):
-                board_id = '0x{:0{}X}'.format(board_id,2)
-            have_found = False
-            for child in self._confdata[0]:
-                if child.attrib["name"] == board_id:
-                    have_found = True
+                board_id = HEX_BYTE(board_id)
+            with self._xml_lock:
+                child = self._boards.pop(board_id, None)
+                if child is not None:
+                    self._ports.pop(board_id, None)
                     self._confdata[0].remove(child)
-            if have_found:
-                return_value = self.write_parameter_file()
+                    # A board that disappeared is written to the file immediately, together with the pending changes.
+                    self._dirty = True
+                    return_value = self.FlushParameterFile()
         return return_value
 
     def CreateNewKey(self, board_id):
@@ -1259,26 +1717,25 @@ class xmlParameterHandler():
         return_value = True
         if self._use_config_file:
             if(isinstance(board_id, int)):
-                board_id = '0x{:0{}X}'.format(board_id,2)
-            # make sure you are not creating a key that already exists
-            self.DeleteKey(board_id)
-
-            attrib = {'name': board_id}
-            element = self._confdata[0].makeelement('board', attrib)
-            self._confdata[0].append(element)
-            index = len(self._confdata[0]) - 1
-
-            attrib = {'name': '0x{:0{}X}'.format(IODIRA,2)}
-            element = self._confdata[0][index].makeelement('port', attrib)
-            element.text = ALLOUTPUTS
-            self._confdata[0][index].append(element)
-
-            attrib = {'name': '0x{:0{}X}'.format(IODIRB,2)}
-            element = self._confdata[0][index].makeelement('port', attrib)
-            element.text = ALLOUTPUTS
-            self._confdata[0][index].append(element)
-
-            return_value = self.write_parameter_file()
+                board_id = HEX_BYTE(board_id)
+            with self._xml_lock:
+                # make sure you are not creating a key that already exists
+                self.DeleteKey(board_id)
+
+                attrib = {'name': board_id}
+                board = self._confdata[0].makeelement('board', attrib)
+                self._confdata[0].append(board)
+                self._boards[board_id] = board
+                self._ports[board_id] = {}
+
+                for port_id in (HEX_BYTE(IODIRA), HEX_BYTE(IODIRB)):
+                    attrib = {'name': port_id}
+                    element = board.makeelement('port', attrib)
+                    element.text = ALLOUTPUTS
+                    board.append(element)
+                    self._ports[board_id][port_id] = element
+
+            self.MarkDirty()
         return return_value
 
     def read_parameter_file(self):
@@ -1291,17 +1748,74 @@ class xmlParameterHandler():
                 self._log.info(2, "Reading Config XML file")
                 try:
                     # Read file, this will fail if the file does not exist (yet)
-                    ConfTree = ET.parse(self._filename)
+                    ConfTree = ET.parse(self._filename, self.XMLParser())
                     self._confdata = ConfTree.getroot()
-                except:
+                    if USE_LXML:
+                        # The parser keeps whitespace in elements without children (e.g. an empty i2cboards element in an older
+                        # file), which would stop lxml from indenting these elements.
+                        for element in self._confdata.iter():
+                            if (element.text is not None) and not element.text.strip():
+                                element.text = None
+                except (ET.ParseError, OSError):
                     self._log.info(2, "Reading Config file FAILED. Creating a new one. ")
-                    self._confdata = ET.fromstring(b'<DATA>\n <i2cboards>\n </i2cboards>\n</DATA>')
+                    self._confdata = ET.fromstring(EMPTY_XML_DATA, self.XMLParser())
                     return_value = self.write_parameter_file()
             else:
-                self._confdata = ET.fromstring(b'<DATA>\n <i2cboards>\n </i2cboards>\n</DATA>')
+                self._confdata = ET.fromstring(EMPTY_XML_DATA, self.XMLParser())
                 return_value = self.write_parameter_file()
+            self.BuildIndex()
+            self._written_state = self.ConfigState()
+        return return_value
+
+    def XMLParser(self):
+        """
+        Returns the parser for reading the XML data. With lxml, the whitespace between the elements is dropped while reading,
+        because lxml only indents elements that do not have whitespace around them yet when writing.
+        """
+        if USE_LXML:
+            return ET.XMLParser(remove_blank_text = True)
+        return None
+
+    def MarkDirty(self):
+        """
+        Remembers that the XML data has changed, and makes sure that it is written to file within XML_FLUSH_DELAY seconds.
+        """
+        with self._xml_lock:
+            self._dirty = True
+            if self._flush_timer is None:
+                self._flush_timer = Timer(XML_FLUSH_DELAY, self.FlushParameterFile)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        return True
+
+    def FlushParameterFile(self):
+        """
+        Writes the XML parameter file if there are changes that are not written yet.
+        """
+        return_value = True
+        with self._xml_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if self._dirty:
+                self._dirty = False
+                # Changes that cancel each other out (e.g. a pin set to input and back to output within XML_FLUSH_DELAY)
+                # leave the same data as in the file. The SD card is then not written at all.
+                state = self.ConfigState()
+                if state != self._written_state:
+                    return_value = self.write_parameter_file()
+                    if return_value:
+                        self._written_state = state
         return return_value
 
+    def ConfigState(self):
+        """
+        Returns the boards, ports and their DIR values in the XML data, in a form that can be compared.
+        """
+        with self._xml_lock:
+            return tuple((board_id, tuple((port_id, port.text) for port_id, port in ports.items())) 
+                         for board_id, ports in self._ports.items())
+
     def write_parameter_file(self):
         """
         Write the XML parameter file from the current home directory. Just try ...
@@ -1310,11 +1824,23 @@ class xmlParameterHandler():
         if self._use_config_file:
             self._log.info(2, "Writing Config file. ")
             try:
-                self.xml_pretty_print(self._confdata[0])
-                outString = ET.tostring(self._confdata)
-                outFile = open(self._filename,"w")
-                outFile.write(outString.decode('ascii'))
-                outFile.close()
+                with self._xml_lock:
+                    # lxml indents the data while writing (pretty_print). With the standard library, ET.indent (Python 3.9
+                    # and up) does the indentation in one go. Older versions fall back to the indentation in Python.
+                    write_options = {}
+                    if USE_LXML:
+                        write_options['pretty_print'] = True
+                    elif hasattr(ET, 'indent'):
+                        ET.indent(self._confdata, space = '  ')
+                    else:
+                        self.xml_pretty_print(self._confdata[0])
+                    # Write the tree straight to the file, without building the whole text in memory first. It is written to
+                    # a temporary file first, which then replaces the old one, so that a crash halfway never leaves a
+                    # broken parameter file behind. The with-block makes sure that the file is closed, also on errors.
+                    temp_filename = "{}.tmp".format(self._filename)
+                    with open(temp_filename, 'wb') as outFile:
+                        ET.ElementTree(self._confdata).write(outFile, encoding = 'ascii', xml_declaration = False, **write_options)
+                    os.replace(temp_filename, self._filename)
                 return_value = True
             except Exception as err:
                 return_value = False
@@ -1322,7 +1848,7 @@ class xmlParameterHandler():
                 self._use_config_file = False
                 if LOG_LEVEL > 0:
                     print("Could not write parameter file [{}]. Error: {}".format(self._filename, err))
-                self._log.info("Could not write parameter file [{}]. Error: {}".format(self._filename, err))
+                self._log.info(1, "Could not write parameter file [%s]. Error: %s", self._filename, err)
         return return_value
 
     def xml_pretty_print(self, element, level=0):
@@ -1331,13 +1857,14 @@ class xmlParameterHandler():
         """
         # Inspired by https://norwied.wordpress.com/2013/08/27/307/
         # Kudos go to Norbert and Chris G. Sellers
-        padding = '  '
-        indent = "\n{}".format(padding * level)
+        # The indentation strings are only built once. The parameter file is never deeper than a few levels.
+        if level < len(XML_INDENTS):
+            indent = XML_INDENTS[level]
+        else:
+            indent = "\n{}".format('  ' * level)
         if len(element):
             if not element.text or not element.text.strip():
-                element.text = "{} ".format(indent)
-            if not element.tail or not element.tail.strip():
-                element.tail = indent
+                element.text = indent + " "
             for elem in element:
                 self.xml_pretty_print(elem, level+1)
             if not element.tail or not element.tail.strip():
@@ -1364,30 +1891,49 @@ class LogThis():
                 self.my_handler = RotatingFileHandler(self._filename, mode='a', maxBytes=10*1024*1024, backupCount=2, encoding=None, delay=0)
                 self.my_handler.setFormatter(self.log_formatter)
                 self.my_handler.setLevel(logging.INFO)
+                # The messages are only put on a queue by the logging threads. A background thread takes them from the
+                # queue and writes them to the file, so that the main loop never waits for the SD card.
+                # At exit, the listener first writes the messages that are still in the queue.
+                log_queue = SimpleQueue()
+                self.log_listener = QueueListener(log_queue, self.my_handler)
+                self.log_listener.start()
+                atexit.register(self.log_listener.stop)
                 self.app_log = logging.getLogger('root')
                 self.app_log.setLevel(logging.INFO)
-                self.app_log.addHandler(self.my_handler)
+                self.app_log.addHandler(QueueHandler(log_queue))
             except Exception as err:
                 self._log_enabled = False
                 if LOG_LEVEL > 0:
                     print("Error while creating log file: {}. ".format(str(err)))
         else:
             self._log_enabled = False
-    
-    def info(self, info_level, info_text):
+        # Without a log file, the logging functions are replaced by one that does nothing, so the calls (which are
+        # everywhere in the code) don't have to check anything.
+        if not self._log_enabled:
+            self.info = self.debug = self.error = self.Ignore
+
+    def Ignore(self, info_level, info_text, *args):
+        """
+        Stand-in for info, debug and error when nothing is logged.
+        """
+        pass
+
+    # The info_text can have %-style placeholders, which are filled in with the args only if the message is really
+    # written to the log file. This avoids formatting strings that are thrown away anyway.
+    def info(self, info_level, info_text, *args):
         if self._log_enabled:
             if (LOG_LEVEL > 1) or (info_level == LOG_LEVEL):
-                self.app_log.info(info_text)
+                self.app_log.info(info_text, *args)
 
-    def debug(self, info_level, info_text):
+    def debug(self, info_level, info_text, *args):
         if self._log_enabled:
             if (LOG_LEVEL > 1) or (info_level == LOG_LEVEL):
-                self.app_log.debug(info_text)
+                self.app_log.debug(info_text, *args)
 
-    def error(self, info_level, info_text):
+    def error(self, info_level, info_text, *args):
         if self._log_enabled:
             if (LOG_LEVEL > 1) or (info_level == LOG_LEVEL):
-                self.app_log.error(info_text)
+                self.app_log.error(info_text, *args)
 
 def InitBusAtBoot(the_log, xmldata, i2chandler):
     """
@@ -1396,33 +1942,61 @@ def InitBusAtBoot(the_log, xmldata, i2chandler):
     # Read the configured boards from the config file
     the_log.info(2, "Reading board information from XML parameter file.")
     boarddata = xmldata.get_all_boards
-    # Process boards one by one
-    for board in boarddata:
-        # Get the board ID (hex board number)
+    # The functions used in the loops are looked up once, before the loops start.
+    log_info = the_log.info
+    write_dir = i2chandler.WriteI2CDir
+    write_dir_pair = i2chandler.WriteI2CDirPair
+    # Process boards one by one. Boards that don't answer are removed from the data, so go over a copy of the list.
+    for board in list(boarddata):
+        # Get the board ID (hex board number), and the board number for the I2C functions
         board_id = board.attrib["name"]
-        # Process both ports in the MCP23017 board (if configured both)
+        board_nr = HEX_VALUE(board_id)
+        # Collect the DIR values of both ports in the MCP23017 board (if configured both)
+        dir_values = {}
         for port in board:
             # Get Port A or B ID
             port_id = port.attrib["name"]
-            # print error message to the systemctl log file
+            # print error message to the systemctl log file. The message is then only formatted once, for both.
+            if LOG_LEVEL == 2:
+                message = "Port [{}] of board [{}] should be set to [{}]".format(port_id, board_id, port.text)
+                print(message)
+                log_info(2, message)
+            else:
+                log_info(2, "Port [%s] of board [%s] should be set to [%s]", port_id, board_id, port.text)
+            # The XML file holds hex strings, the I2C functions only take int.
+            dir_values[HEX_VALUE(port_id)] = HEX_VALUE(port.text)
+        # Write the I/O state to the ports. If both ports are known, they are written in one go.
+        if (IODIRA in dir_values) and (IODIRB in dir_values):
+            success = write_dir_pair(board_nr, dir_values.pop(IODIRA), dir_values.pop(IODIRB))
+        else:
+            success = True
+        for port_id, newvalue in dir_values.items():
+            success = write_dir(board_nr, port_id, newvalue) and success
+        if not(success):
             if LOG_LEVEL == 2:
-                print("Port [{}] of board [{}] should be set to [{}]".format(port_id, board_id, port.text))
-            the_log.info(2, "Port [{}] of board [{}] should be set to [{}]".format(port_id, board_id, port.text))
-            # Write the I/O state to the port
-            if not(i2chandler.WriteI2CDir(board_id, port_id, port.text)):
-                if LOG_LEVEL == 2:
-                    print("That didn't work for board [{}]".format(board_id))
-                    the_log.info(2, "That didn't work for board [{}]".format(board_id))
-                # If that didn't work, the board may have been removed before booting. Remove it from the config file.
-                xmldata.DeleteKey(board_id)
+                message = "That didn't work for board [{}]".format(board_id)
+                print(message)
+                log_info(2, message)
+            # If that didn't work, the board may have been removed before booting. Remove it from the config file.
+            xmldata.DeleteKey(board_id)
+
+def StopOnSignal(signum, frame):
+    """
+    Stops the program in a normal way when the service is stopped (e.g. 'systemctl stop', or a reboot), which sends 
+    a SIGTERM. By default, Python ends on a SIGTERM without running the atexit functions, and then the XML changes
+    that are waiting for XML_FLUSH_DELAY and the log messages that are still queued would be lost.
+    """
+    sys.exit(0)
 
 def main():
     """
     Main program function.
     """
+    # Make sure that the atexit functions also run when the service is stopped.
+    signal.signal(signal.SIGTERM, StopOnSignal)
     # Start a logger and provide info
     my_log = LogThis()
-    my_log.info(1, "mcp23017server starting, running version [{}].".format(VERSION))
+    my_log.info(1, "mcp23017server starting, running version [%s].", VERSION)
     # Parameter file for board input/output configurations
     my_log.info(2, "Creating XML Parameter Handler")
     xmldata = xmlParameterHandler(my_log)
@@ -1435,10 +2009,14 @@ def main():
     # Set up a new broker - this is the main part of the software.
     my_log.info(2, "Creating a Message Broker")
     mybroker = mcp23017broker(my_log, i2chandler, xmldata)
-    # Process commands forever
+    # Process commands forever. The broker methods are bound locally, so they are not looked up again at every pass.
+    # When all commands are processed, the server blocks on the command queue until a client pushes the next one.
+    service_commands = mybroker.service_commands
+    wait_for_commands = mybroker.WaitForCommands
     while True:
-        mybroker.service_commands()
-    my_log.error(1, "FATAL EXIT WITH ERROR [{}]".format(my_error_state))
+        if not service_commands():
+            wait_for_commands(IDLE_WAIT)
+    my_log.error(1, "FATAL EXIT WITH ERROR [%s]", my_error_state)
     # Do a controlled exist with fail code. Trigger the OS to restart the service if configured.
     sys.exit(1)
 